@@ -1,19 +1,2218 @@
+import argparse
+import bisect
+import csv
+import functools
+import hashlib
+import heapq
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import numpy as np
 from PySide2 import QtCore
-from PySide2.QtCore import Qt, QSize, QRect, QPoint
-from PySide2.QtGui import QKeySequence, QIntValidator, QPainter, QPixmap, QColor, QPen, QCursor, QMatrix, QPalette
+from PySide2.QtCore import Qt, QEvent, QSize, QRect, QRectF, QPoint, QPointF
+from PySide2.QtGui import QKeySequence, QIntValidator, QPainter, QPainterPath, QPixmap, QImage, QImageReader, QImageIOHandler, QColor, QPen, QCursor, QMatrix, QMouseEvent, QTransform, QPalette
 from PySide2.QtWidgets import QApplication
 from PySide2.QtWidgets import QDesktopWidget
 from PySide2.QtWidgets import QHBoxLayout
 from PySide2.QtWidgets import QLabel
+from PySide2.QtWidgets import QListView
 from PySide2.QtWidgets import QPushButton
 from PySide2.QtWidgets import QShortcut
 from PySide2.QtWidgets import QVBoxLayout
-from PySide2.QtWidgets import QWidget, QLineEdit, QMessageBox, QFileDialog, QColorDialog
+from PySide2.QtWidgets import QWidget, QLineEdit, QMessageBox, QFileDialog, QColorDialog, QInputDialog
+
+
+IMG_SUFFIXES = ['.JPG', '.JPEG', '.BMP', '.PNG']
+
+
+# bmp: 和原来一样的24位BMP, png1: 1位PNG, png8: 8位索引PNG, rle: 游程编码文件
+MASK_FORMATS = ['bmp', 'png1', 'png8', 'rle']
+MASK_FORMAT_SUFFIXES = {'bmp': '.bmp', 'png1': '.png', 'png8': '.png', 'rle': '.rle'}
+RLE_MAGIC = b'MRLE'
+
+
+def percentile_stats(values):
+    values = np.asarray(values, np.float64) * 1000
+    if len(values) == 0:
+        return {'n': 0}
+    return {
+        'n': len(values),
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max()),
+    }
+
+
+class Profiler(object):
+    # 记录各类操作的耗时, 保留最近的样本计算百分位数, 并可以导出chrome://tracing格式的json
+    # 没有启用时只多一次属性判断
+    def __init__(self, window=500, max_events=200000):
+        self.enabled = False
+        self.trace_path = None
+        self.window = window
+        self.samples = {}
+        self.events = deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def enable(self, trace_path=None):
+        self.enabled = True
+        self.trace_path = trace_path or None
+
+    def record(self, name, start, end):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(end - start)
+            self.events.append((name, threading.get_ident(), start, end))
+
+    def stats(self, name):
+        with self.lock:
+            values = list(self.samples.get(name, []))
+        return percentile_stats(values)
+
+    def summary(self, names):
+        text = []
+        for name in names:
+            stats = self.stats(name)
+            if stats['n']:
+                text.append(f'{name} {stats["p50_ms"]:.1f}/{stats["p95_ms"]:.1f}/{stats["p99_ms"]:.1f}ms')
+        return '  '.join(text)
+
+    def export_chrome_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+
+        pid = os.getpid()
+        trace = [{
+            'name': name,
+            'cat': name,
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': pid,
+            'tid': tid,
+        } for name, tid, start, end in events]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.record(name, start, time.perf_counter())
+        return wrapper
+    return decorator
+
+
+def get_mask_img_path(img_path, mask_format='bmp'):
+    return img_path.parent.joinpath(f'mask/{img_path.stem}{MASK_FORMAT_SUFFIXES[mask_format]}')
+
+
+def get_data_path(directory, name):
+    # 索引和缓存文件放在图片目录下的.masklabel目录里, sqlite的临时文件不会触发图片目录的变化通知
+    data_dir = Path(directory).joinpath('.masklabel')
+    data_dir.mkdir(exist_ok=True)
+    path = data_dir.joinpath(name)
+    old_path = Path(directory).joinpath(name)
+    if not path.exists() and old_path.exists():
+        # 旧版本直接放在图片目录下
+        os.replace(str(old_path), str(path))
+    return path
+
+
+def find_mask_img_path(img_path, mask_format='bmp'):
+    # 优先使用当前格式的mask, 没有的话再找其他格式的mask
+    mask_img_path = get_mask_img_path(img_path, mask_format)
+    if mask_img_path.exists():
+        return mask_img_path
+
+    for suffix in sorted(set(MASK_FORMAT_SUFFIXES.values())):
+        other_mask_img_path = mask_img_path.with_suffix(suffix)
+        if other_mask_img_path != mask_img_path and other_mask_img_path.exists():
+            return other_mask_img_path
+    return mask_img_path
+
+
+def qimage_to_array(img, writable=False):
+    # 32位格式的QImage转换成(高, 宽, 4)的numpy数组, 和QImage共享内存
+    bits = img.bits() if writable else img.constBits()
+    arr = np.frombuffer(bits, np.uint8, count=img.bytesPerLine() * img.height())
+    return arr.reshape(img.height(), img.bytesPerLine() // 4, 4)[:, :img.width()]
+
+
+def mask_foreground(img):
+    if img.format() == QImage.Format_Grayscale8:
+        return mask_array(img) > 0
+    if img.format() != QImage.Format_RGB32:
+        img = img.convertToFormat(QImage.Format_RGB32)
+    return qimage_to_array(img)[:, :, :3].any(axis=2)
+
+
+def foreground_to_image(foreground, mask_format='png8'):
+    h, w = foreground.shape
+    if mask_format == 'png1':
+        img = QImage(w, h, QImage.Format_Mono)
+        bits = np.packbits(foreground, axis=1)
+    else:
+        img = QImage(w, h, QImage.Format_Indexed8)
+        bits = foreground.astype(np.uint8)
+    img.setColorTable([QColor(0, 0, 0).rgb(), QColor(255, 255, 255).rgb()])
+
+    arr = np.frombuffer(img.bits(), np.uint8, count=img.bytesPerLine() * h).reshape(h, img.bytesPerLine())
+    arr[:, :bits.shape[1]] = bits
+    return img
+
+
+def mask_array(img, writable=False):
+    # 8位灰度mask转换成(高, 宽)的numpy数组, 和QImage共享内存
+    bits = img.bits() if writable else img.constBits()
+    arr = np.frombuffer(bits, np.uint8, count=img.bytesPerLine() * img.height())
+    return arr.reshape(img.height(), img.bytesPerLine())[:, :img.width()]
+
+
+# 界面内部的mask统一用8位灰度图, 0为背景, 255为标注, 显示和保存时再通过颜色表换成画笔颜色
+def new_mask_image(size):
+    img = QImage(size, QImage.Format_Grayscale8)
+    img.fill(0)
+    return img
+
+
+def foreground_to_mask_image(foreground):
+    h, w = foreground.shape
+    img = QImage(w, h, QImage.Format_Grayscale8)
+    mask_array(img, writable=True)[...] = foreground * np.uint8(255)
+    return img
+
+
+def to_mask_image(img):
+    if img.format() == QImage.Format_Grayscale8:
+        return img
+    return foreground_to_mask_image(mask_foreground(img))
+
+
+def mask_color_table(color, opacity=1.0, background=None):
+    # 非0的值都映射成画笔颜色, 不透明度放在alpha通道里, 一次查表完成着色
+    fg = QColor(color)
+    fg.setAlphaF(opacity)
+    bg = background.rgba() if background is not None else 0
+    return [bg] + [fg.rgba()] * 255
+
+
+def indexed_mask_view(img, rect, color_table):
+    # 复制出需要的区域后直接把灰度数据当作索引图使用, 不需要逐像素转换
+    view = img.copy(rect)
+    view.reinterpretAsFormat(QImage.Format_Indexed8)
+    view.setColorTable(color_table)
+    return view
+
+
+def mask_to_color_image(img, color):
+    # 保存成bmp时和原来一样: 标注为画笔颜色, 背景为黑色
+    view = indexed_mask_view(img, img.rect(), mask_color_table(color, 1.0, QColor(0, 0, 0)))
+    return view.convertToFormat(QImage.Format_RGB32)
+
+
+def image_to_gray_array(img):
+    if img.format() == QImage.Format_Grayscale8:
+        # 灰度图直接读取原始值, 不经过彩色转换
+        return mask_array(img).copy()
+    if img.format() != QImage.Format_RGB32:
+        img = img.convertToFormat(QImage.Format_RGB32)
+    arr = qimage_to_array(img)
+    gray = arr[:, :, 2] * 0.299 + arr[:, :, 1] * 0.587 + arr[:, :, 0] * 0.114
+    return np.rint(gray).astype(np.uint8)
+
+
+def dilate_mask(foreground, n):
+    # 方形结构元素, 按行和按列分两遍做最大值滤波
+    out = foreground.copy()
+    for s in range(1, n + 1):
+        out[:, s:] |= foreground[:, :-s]
+        out[:, :-s] |= foreground[:, s:]
+    rows = out.copy()
+    for s in range(1, n + 1):
+        out[s:] |= rows[:-s]
+        out[:-s] |= rows[s:]
+    return out
+
+
+def erode_mask(foreground, n):
+    return ~dilate_mask(~foreground, n)
+
+
+def label_components(foreground):
+    # 4连通域标记: 先把每行切成连续的段, 再用并查集合并上下相邻的段
+    # 返回每个像素的连通域编号(背景为-1)和连通域个数
+    h, w = foreground.shape
+    starts = foreground.copy()
+    starts[:, 1:] &= ~foreground[:, :-1]
+    run_id = np.cumsum(starts.ravel(), dtype=np.int32).reshape(h, w) - 1
+    n = int(starts.sum())
+
+    labels = np.full((h, w), -1, np.int32)
+    if n == 0:
+        return labels, 0
+
+    vertical = foreground[:-1] & foreground[1:]
+    pairs = np.unique(run_id[:-1][vertical].astype(np.int64) * n + run_id[1:][vertical])
+    a = pairs // n
+    b = pairs % n
+
+    parent = np.arange(n, dtype=np.int32)
+    while True:
+        la = parent[a]
+        lb = parent[b]
+        if (la == lb).all():
+            break
+        m = np.minimum(la, lb)
+        np.minimum.at(parent, la, m)
+        np.minimum.at(parent, lb, m)
+        parent = parent[parent]
+    while (parent[parent] != parent).any():
+        parent = parent[parent]
+
+    roots, run_label = np.unique(parent, return_inverse=True)
+    labels[foreground] = run_label[run_id[foreground]]
+    return labels, len(roots)
+
+
+def fill_mask_holes(foreground):
+    # 不和图片边缘连通的背景区域就是空洞
+    background = ~foreground
+    labels, count = label_components(background)
+    border = np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])
+    outside = np.zeros(count + 1, bool)
+    outside[border] = True
+    return foreground | (background & ~outside[labels])
+
+
+def remove_small_components(foreground, min_area):
+    labels, count = label_components(foreground)
+    areas = np.bincount(labels[foreground], minlength=count)
+    out = foreground.copy()
+    out[foreground] = areas[labels[foreground]] >= min_area
+    return out
+
+
+def flood_fill_region(region, x, y, max_runs=50000):
+    # 从(x, y)开始的4连通区域, 按行段扫描填充, 只处理种子所在区域经过的行,
+    # 区域非常零碎(行段太多)时逐段处理太慢, 改为整张图一次做连通域标记
+    filled = np.zeros_like(region)
+    if not region[y, x]:
+        return filled
+
+    row_runs = {}
+
+    def runs_of(row):
+        if row not in row_runs:
+            padded = np.concatenate(([False], region[row], [False]))
+            edges = np.flatnonzero(padded[1:] != padded[:-1])
+            row_runs[row] = (edges[::2].tolist(), edges[1::2].tolist())
+        return row_runs[row]
+
+    starts, ends = runs_of(y)
+    seed = (y, bisect.bisect_right(starts, x) - 1)
+    visited = {seed}
+    stack = [seed]
+    while stack:
+        row, i = stack.pop()
+        start, end = row_runs[row][0][i], row_runs[row][1][i]
+        filled[row, start:end] = True
+        for r in (row - 1, row + 1):
+            if not 0 <= r < region.shape[0]:
+                continue
+            # 上下两行中和[start, end)有重叠的行段
+            starts, ends = runs_of(r)
+            for j in range(bisect.bisect_right(ends, start), bisect.bisect_left(starts, end)):
+                if (r, j) not in visited:
+                    visited.add((r, j))
+                    stack.append((r, j))
+        if len(visited) > max_runs:
+            labels, _ = label_components(region)
+            return labels == labels[y, x]
+    return filled
+
+
+def color_similar_region(rgb, x, y, tolerance):
+    # 魔棒: 和种子点各通道颜色差都不超过容差的像素
+    diff = np.abs(rgb.astype(np.int16) - rgb[y, x].astype(np.int16))
+    return diff.max(axis=2) <= tolerance
+
+
+def otsu_threshold(gray):
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * np.arange(256))
+    mean0 = m0 / np.maximum(w0, 1)
+    mean1 = (m0[-1] - m0) / np.maximum(w1, 1)
+    return int(np.argmax(w0 * w1 * (mean0 - mean1) ** 2))
+
+
+def threshold_mask(gray, threshold):
+    return gray >= threshold
+
+
+def read_rle_mask(path):
+    with open(str(path), 'rb') as f:
+        data = f.read()
+
+    if data[:4] != RLE_MAGIC:
+        return QImage()
+
+    w, h, n = struct.unpack_from('<III', data, 4)
+    runs = np.frombuffer(data, '<u4', n, 16)
+    if int(runs.sum()) != w * h:
+        return QImage()
+
+    foreground = np.repeat((np.arange(n) % 2).astype(bool), runs).reshape(h, w)
+    return foreground_to_image(foreground)
+
+
+def write_rle_mask(path, foreground):
+    h, w = foreground.shape
+    flat = foreground.ravel()
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], change, [flat.size])))
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs))
+
+    with open(str(path), 'wb') as f:
+        f.write(RLE_MAGIC + struct.pack('<III', w, h, len(runs)))
+        f.write(runs.astype('<u4').tobytes())
+
+
+@profiled('mask_load')
+def read_mask_image(path):
+    if Path(path).suffix.lower() == '.rle':
+        return read_rle_mask(path)
+    return QImage(str(path))
+
+
+@profiled('mask_save')
+def write_mask_image(path, img, mask_format='bmp', color=None):
+    # 先写临时文件再替换, 保存过程中程序退出也不会留下损坏的mask
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        if mask_format == 'bmp':
+            if img.format() == QImage.Format_Grayscale8:
+                # 背景是黑色, 无效或者黑色的画笔颜色会把标注写成背景, 这时用默认的黄色
+                if color is None or not color.isValid() or color.rgb() & 0xffffff == 0:
+                    color = QColor(255, 255, 0)
+                img = mask_to_color_image(img, color)
+            if not img.save(tmp_path, 'BMP'):
+                raise IOError(f'无法写入文件 {tmp_path}')
+        elif mask_format == 'rle':
+            write_rle_mask(tmp_path, mask_foreground(img))
+        else:
+            if not foreground_to_image(mask_foreground(img), mask_format).save(tmp_path, 'PNG'):
+                raise IOError(f'无法写入文件 {tmp_path}')
+        os.replace(tmp_path, str(path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def convert_mask_file(mask_img_path, mask_format, remove_source=False):
+    try:
+        new_mask_img_path = mask_img_path.with_suffix(MASK_FORMAT_SUFFIXES[mask_format])
+        if new_mask_img_path.exists():
+            return 'skipped'
+
+        img = read_mask_image(mask_img_path)
+        if img.isNull():
+            return 'failed'
+
+        foreground = mask_foreground(img)
+        write_mask_image(new_mask_img_path, img, mask_format)
+
+        new_img = read_mask_image(new_mask_img_path)
+        if new_img.isNull() or not np.array_equal(mask_foreground(new_img), foreground):
+            os.remove(str(new_mask_img_path))
+            return 'failed'
+
+        if remove_source:
+            os.remove(str(mask_img_path))
+        return 'converted'
+    except:
+        logging.exception(f'convert {mask_img_path} exception')
+        return 'failed'
+
+
+def convert_masks(directory, mask_format, workers=None, remove_source=False):
+    mask_dir = Path(directory).joinpath('mask')
+    suffix = MASK_FORMAT_SUFFIXES[mask_format]
+    all_mask_file = sorted([x for x in mask_dir.iterdir() if x.is_file()
+                            and x.suffix.lower() in MASK_FORMAT_SUFFIXES.values() and x.suffix.lower() != suffix])
+
+    results = {'converted': 0, 'skipped': 0, 'failed': 0}
+    with ProcessPoolExecutor(workers) as executor:
+        jobs = executor.map(convert_mask_file, all_mask_file, [mask_format] * len(all_mask_file),
+                            [remove_source] * len(all_mask_file), chunksize=64)
+        for i, result in enumerate(jobs):
+            results[result] += 1
+            print(f'\r{i + 1}/{len(all_mask_file)}', end='', flush=True)
+
+    print(f'\n转换完成: {results}')
+    return results
+
+
+def image_native_size(path):
+    # 按EXIF方向旋转之后的原图大小, 不解码图片
+    reader = QImageReader(str(path))
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if reader.transformation() & QImageIOHandler.TransformationRotate90:
+        size.transpose()
+    return size
+
+
+def resample_mask_image(img, size):
+    # 最近邻缩放, 保持标注边缘清晰, 不产生中间颜色
+    if img.format() != QImage.Format_RGB32:
+        img = img.convertToFormat(QImage.Format_RGB32)
+    return img.scaled(size, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+
+
+def resample_mask_file(img_path, size, mask_format):
+    try:
+        mask_img_path = find_mask_img_path(img_path, mask_format)
+        if not mask_img_path.exists():
+            return 'skipped'
+
+        img = read_mask_image(mask_img_path)
+        if img.isNull():
+            return 'failed'
+
+        target_size = QSize(*size) if size is not None else image_native_size(img_path)
+        if target_size.isEmpty():
+            return 'failed'
+        if img.size() == target_size:
+            return 'skipped'
+
+        write_mask_image(mask_img_path, resample_mask_image(img, target_size), mask_format_of(mask_img_path, img))
+        return 'resampled'
+    except:
+        logging.exception(f'resample {img_path} exception')
+        return 'failed'
+
+
+def resample_masks(directory, mask_format, size=None, workers=None):
+    # size为None时缩放到各自原图的大小
+    all_img_file = list_img_files(directory)
+
+    results = {'resampled': 0, 'skipped': 0, 'failed': 0}
+    with ProcessPoolExecutor(workers) as executor:
+        jobs = executor.map(resample_mask_file, all_img_file, [size] * len(all_img_file),
+                            [mask_format] * len(all_img_file), chunksize=64)
+        for i, result in enumerate(jobs):
+            results[result] += 1
+            print(f'\r{i + 1}/{len(all_img_file)}', end='', flush=True)
+
+    print(f'\n缩放完成: {results}')
+    return results
+
+
+# EXIF方向顺时针旋转90度后的新方向
+EXIF_ROTATE_CW = {1: 6, 6: 3, 3: 8, 8: 1, 2: 7, 7: 4, 4: 5, 5: 2}
+
+
+def find_jpeg_exif_orientation(data):
+    # 返回EXIF方向值在文件中的位置, 字节序和EXIF段的位置, 没有EXIF返回(None, None, None), 有EXIF但没有方向时位置为-1
+    if data[:2] != b'\xff\xd8':
+        return None, None, None
+
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xff:
+        marker = data[pos + 1]
+        if marker == 0xda or marker == 0xd9:
+            break
+        length = struct.unpack_from('>H', data, pos + 2)[0]
+
+        if marker == 0xe1 and data[pos + 4:pos + 10] == b'Exif\x00\x00':
+            tiff = pos + 10
+            endian = '<' if data[tiff:tiff + 2] == b'II' else '>'
+            ifd = tiff + struct.unpack_from(endian + 'I', data, tiff + 4)[0]
+            count = struct.unpack_from(endian + 'H', data, ifd)[0]
+            for i in range(count):
+                entry = ifd + 2 + i * 12
+                tag, tag_type = struct.unpack_from(endian + 'HH', data, entry)
+                if tag == 0x0112 and tag_type == 3:
+                    return entry + 8, endian, pos
+            return -1, endian, pos
+
+        pos += 2 + length
+    return None, None, None
+
+
+def add_jpeg_exif_orientation(data, segment, endian, orientation):
+    # 把IFD0复制到EXIF段末尾并加上方向, 原来的数据都不移动, 其它IFD和缩略图的偏移量不需要修改
+    length = struct.unpack_from('>H', data, segment + 2)[0]
+    tiff = segment + 10
+    end = segment + 2 + length
+    ifd = tiff + struct.unpack_from(endian + 'I', data, tiff + 4)[0]
+    count = struct.unpack_from(endian + 'H', data, ifd)[0]
+    entries = [bytes(data[ifd + 2 + i * 12:ifd + 14 + i * 12]) for i in range(count)]
+    entries.append(struct.pack(endian + 'HHIHH', 0x0112, 3, 1, orientation, 0))
+    entries.sort(key=lambda x: struct.unpack_from(endian + 'H', x)[0])
+    next_ifd = bytes(data[ifd + 2 + count * 12:ifd + 6 + count * 12])
+
+    # IFD要从偶数偏移开始
+    padding = (end - tiff) % 2
+    new_ifd = b'\x00' * padding + struct.pack(endian + 'H', len(entries)) + b''.join(entries) + next_ifd
+    if length + len(new_ifd) > 0xffff:
+        return False
+
+    struct.pack_into(endian + 'I', data, tiff + 4, end + padding - tiff)
+    struct.pack_into('>H', data, segment + 2, length + len(new_ifd))
+    data[end:end] = new_ifd
+    return True
+
+
+def rotate_jpeg_exif(img_path):
+    # 只修改EXIF中的方向, 不重新编码jpeg的像素数据
+    with open(str(img_path), 'rb') as f:
+        data = bytearray(f.read())
+
+    pos, endian, segment = find_jpeg_exif_orientation(data)
+    if data[:2] != b'\xff\xd8':
+        return False
+
+    if pos == -1:
+        if not add_jpeg_exif_orientation(data, segment, endian, EXIF_ROTATE_CW[1]):
+            return False
+    elif pos is None:
+        exif = b'Exif\x00\x00MM\x00*' + struct.pack('>IHHHIHHI', 8, 1, 0x0112, 3, 1, EXIF_ROTATE_CW[1], 0, 0)
+        data[2:2] = b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif
+    else:
+        orientation = struct.unpack_from(endian + 'H', data, pos)[0]
+        struct.pack_into(endian + 'H', data, pos, EXIF_ROTATE_CW.get(orientation, EXIF_ROTATE_CW[1]))
+
+    tmp_path = f'{img_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, str(img_path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
+def rotate_img_file(img_path):
+    if img_path.suffix.upper() in ['.JPG', '.JPEG'] and rotate_jpeg_exif(img_path):
+        return
+
+    # png和bmp本身是无损格式, 直接旋转像素重新保存
+    img = load_image(img_path)
+    if img.isNull():
+        raise IOError(f'无法读取图片 {img_path}')
+
+    rm = QMatrix()
+    rm.rotate(90)
+    img = img.transformed(rm)
+    if not img.save(str(img_path)):
+        raise IOError(f'无法写入图片 {img_path}')
+
+
+def mask_format_of(mask_img_path, img):
+    suffix = mask_img_path.suffix.lower()
+    if suffix == '.png':
+        return 'png1' if img.format() in [QImage.Format_Mono, QImage.Format_MonoLSB] else 'png8'
+    return suffix[1:]
+
+
+def rotate_mask_file(img_path, mask_format):
+    mask_img_path = find_mask_img_path(img_path, mask_format)
+    if not mask_img_path.exists():
+        return
+
+    img = read_mask_image(mask_img_path)
+    if img.isNull():
+        raise IOError(f'无法读取标注文件 {mask_img_path}')
+
+    rm = QMatrix()
+    rm.rotate(90)
+    write_mask_image(mask_img_path, img.transformed(rm), mask_format_of(mask_img_path, img))
+
+
+def rotate_file_pair(img_path, mask_format, rotate_img=True, rotate_mask=True):
+    try:
+        if rotate_img:
+            rotate_img_file(img_path)
+        if rotate_mask:
+            rotate_mask_file(img_path, mask_format)
+        return None
+    except Exception as e:
+        logging.exception(f'rotate {img_path} exception')
+        return f'{img_path}: {e}'
+
+
+def list_img_files(directory):
+    with os.scandir(str(directory)) as it:
+        return sorted([Path(x.path) for x in it if os.path.splitext(x.name)[1].upper() in IMG_SUFFIXES and x.is_file()])
+
+
+def image_to_rgb_array(img):
+    if img.format() != QImage.Format_RGB888:
+        img = img.convertToFormat(QImage.Format_RGB888)
+    arr = np.frombuffer(img.constBits(), np.uint8, count=img.bytesPerLine() * img.height())
+    return arr.reshape(img.height(), img.bytesPerLine())[:, :img.width() * 3].reshape(img.height(), img.width(), 3).copy()
+
+
+def export_chunk(out_dir, img_files, start, size, mask_format, with_images):
+    # 每个进程直接写入内存映射文件中自己负责的那一段, 不需要把数据传回主进程
+    qsize = QSize(*size)
+    masks = np.load(str(out_dir.joinpath('masks.npy')), mmap_mode='r+')
+    images = np.load(str(out_dir.joinpath('images.npy')), mmap_mode='r+') if with_images else None
+
+    rows = []
+    for i, img_path in enumerate(img_files, start):
+        if images is not None:
+            img = load_image(img_path, qsize)
+            if not img.isNull():
+                images[i] = image_to_rgb_array(img)
+
+        mask_img_path = find_mask_img_path(img_path, mask_format)
+        mask_img = read_mask_image(mask_img_path) if mask_img_path.exists() else QImage()
+        if mask_img.isNull():
+            masks[i] = 0
+            rows.append((i, img_path.name, '', 0))
+            continue
+
+        if mask_img.size() != qsize:
+            mask_img = mask_img.convertToFormat(QImage.Format_RGB32).scaled(qsize, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+        foreground = mask_foreground(mask_img)
+        masks[i] = foreground
+        rows.append((i, img_path.name, mask_img_path.name, int(np.count_nonzero(foreground))))
+
+    masks.flush()
+    if images is not None:
+        images.flush()
+    return rows
+
+
+def export_dataset(directory, out_dir, mask_format='bmp', size=(512, 512), workers=None, chunk_size=256, with_images=True):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    all_img_file = list_img_files(directory)
+    w, h = size
+
+    np.lib.format.open_memmap(str(out_dir.joinpath('masks.npy')), 'w+', np.uint8, (len(all_img_file), h, w))
+    if with_images:
+        np.lib.format.open_memmap(str(out_dir.joinpath('images.npy')), 'w+', np.uint8, (len(all_img_file), h, w, 3))
+
+    chunks = [all_img_file[i:i + chunk_size] for i in range(0, len(all_img_file), chunk_size)]
+    with open(str(out_dir.joinpath('index.csv')), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['index', 'image', 'mask', 'mask_pixels'])
+
+        done = 0
+        with ProcessPoolExecutor(workers) as executor:
+            jobs = executor.map(export_chunk, [out_dir] * len(chunks), chunks, range(0, len(all_img_file), chunk_size),
+                                [size] * len(chunks), [mask_format] * len(chunks), [with_images] * len(chunks))
+            for rows in jobs:
+                writer.writerows(rows)
+                done += len(rows)
+                print(f'\r{done}/{len(all_img_file)}', end='', flush=True)
+
+    print(f'\n导出完成: {out_dir}')
+    return len(all_img_file)
+
+
+PREDICTION_SUFFIXES = ['.PNG', '.BMP', '.NPY']
+
+
+def read_prediction(path, threshold=None, label=None):
+    # 预标注可以是概率图或者类别图, 浮点数组和灰度图片是概率图, 按threshold(默认0.5)取阈值, 灰度图片的阈值是threshold*255,
+    # 调色板图片, 整数数组和只有0/1两个值的灰度图片是类别图, 指定label时只取这个类别, 否则非0即为前景
+    if path.suffix.upper() == '.NPY':
+        arr = np.load(str(path), mmap_mode='r')
+        if arr.ndim == 3 and 1 in (arr.shape[0], arr.shape[-1]):
+            arr = arr.reshape(arr.shape[1:] if arr.shape[0] == 1 else arr.shape[:-1])
+        if arr.ndim != 2:
+            raise ValueError(f'不支持的数组形状 {arr.shape}')
+        if label is not None:
+            return np.asarray(arr == label)
+        if np.issubdtype(arr.dtype, np.floating):
+            return np.asarray(arr >= (0.5 if threshold is None else threshold))
+        if threshold is not None:
+            return np.asarray(arr >= threshold * np.iinfo(arr.dtype).max)
+        return np.asarray(arr != 0)
+
+    img = QImage(str(path))
+    if img.isNull():
+        raise ValueError('无法读取图片')
+    if img.format() == QImage.Format_Indexed8:
+        # 调色板PNG里每个像素的值就是类别编号, 不取阈值
+        arr = np.frombuffer(img.constBits(), np.uint8, count=img.bytesPerLine() * img.height())
+        arr = arr.reshape(img.height(), img.bytesPerLine())[:, :img.width()]
+        return arr == label if label is not None else arr != 0
+    grayscale = img.format() == QImage.Format_Grayscale8
+    if threshold is None and label is None and not grayscale:
+        # 彩色的标注图, 和mask一样任意通道非0即为前景
+        return mask_foreground(img)
+
+    arr = image_to_gray_array(img)
+    if label is not None:
+        return arr == label
+    if threshold is None and arr.max() <= 1:
+        return arr != 0
+    return arr >= (0.5 if threshold is None else threshold) * 255
+
+
+def import_mask_file(pred_path, img_path, mask_format, size, threshold, label, record, force=False):
+    # record是上次导入时记录的(预标注修改时间, 预标注大小, mask文件名, mask修改时间, mask大小, mask哈希)
+    try:
+        pst = pred_path.stat()
+        mask_img_path = find_mask_img_path(img_path, mask_format)
+        if mask_img_path.exists() and not force and (record is None or record[2] != mask_img_path.name):
+            # 没有导入记录的mask, 如果是打开图片时自动创建的空白mask就可以覆盖
+            img = read_mask_image(mask_img_path)
+            if img.isNull() or mask_stats(img)[0] > 0:
+                return 'edited', None
+        elif mask_img_path.exists() and not force:
+            mst = mask_img_path.stat()
+            untouched = (mst.st_mtime_ns, mst.st_size) == record[3:5]
+            if not untouched:
+                # 修改时间变了但内容没变(比如重新保存了一次), 仍然算作没有手工修改过
+                img = read_mask_image(mask_img_path)
+                untouched = not img.isNull() and mask_stats(img)[1] == record[5]
+            if not untouched:
+                return 'edited', None
+            if (pst.st_mtime_ns, pst.st_size) == record[:2]:
+                return 'unchanged', None
+
+        foreground = read_prediction(pred_path, threshold, label)
+        mask_img = foreground_to_mask_image(np.ascontiguousarray(foreground))
+        target_size = QSize(*size) if size is not None else image_native_size(img_path)
+        if target_size.isEmpty():
+            return 'failed', None
+        if mask_img.size() != target_size:
+            mask_img = mask_img.scaled(target_size, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+
+        mask_img_path = get_mask_img_path(img_path, mask_format)
+        mask_img_path.parent.mkdir(exist_ok=True)
+        write_mask_image(mask_img_path, mask_img, mask_format)
+        mst = mask_img_path.stat()
+        return 'imported', (pst.st_mtime_ns, pst.st_size, mask_img_path.name, mst.st_mtime_ns, mst.st_size, mask_stats(mask_img)[1])
+    except:
+        logging.exception(f'import {pred_path} exception')
+        return 'failed', None
+
+
+def import_masks(pred_dir, directory, mask_format='bmp', size=(512, 512), threshold=None, label=None,
+                 workers=None, force=False):
+    # 导入记录保存在图片目录下的sqlite里, 导入之后被手工修改过的mask不会被覆盖
+    directory = Path(directory)
+    img_files = {x.stem: x for x in reversed(list_img_files(directory))}
+    with os.scandir(str(pred_dir)) as it:
+        pred_files = sorted(Path(x.path) for x in it if os.path.splitext(x.name)[1].upper() in PREDICTION_SUFFIXES and x.is_file())
+
+    pairs = []
+    unmatched = 0
+    for pred_path in pred_files:
+        if pred_path.stem in img_files:
+            pairs.append((pred_path, img_files.pop(pred_path.stem)))
+        else:
+            unmatched += 1
+
+    conn = sqlite3.connect(str(get_data_path(directory, 'mask_import.db')))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS imports (
+            stem TEXT PRIMARY KEY,
+            pred_mtime_ns INTEGER,
+            pred_size INTEGER,
+            mask_name TEXT,
+            mask_mtime_ns INTEGER,
+            mask_size INTEGER,
+            mask_hash TEXT
+        )''')
+    records = {row[0]: row[1:] for row in conn.execute('SELECT * FROM imports')}
+
+    results = {'imported': 0, 'unchanged': 0, 'edited': 0, 'failed': 0, 'unmatched': unmatched}
+    changed = []
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            jobs = executor.map(import_mask_file, [x[0] for x in pairs], [x[1] for x in pairs], [mask_format] * len(pairs),
+                                [size] * len(pairs), [threshold] * len(pairs), [label] * len(pairs),
+                                [records.get(x[1].stem) for x in pairs], [force] * len(pairs), chunksize=64)
+            for i, (result, record) in enumerate(jobs):
+                results[result] += 1
+                if record is not None:
+                    changed.append((pairs[i][1].stem,) + record)
+                if len(changed) >= 500:
+                    conn.executemany('INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?, ?, ?)', changed)
+                    conn.commit()
+                    changed = []
+                print(f'\r{i + 1}/{len(pairs)}', end='', flush=True)
+    finally:
+        conn.executemany('INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?, ?, ?)', changed)
+        conn.commit()
+        conn.close()
+
+    print(f'\n导入完成: {results}')
+    return results
+
+
+REPORT_FIELDS = ['image', 'mask', 'status', 'problems', 'width', 'height', 'mask_pixels', 'coverage',
+                 'bbox_x', 'bbox_y', 'bbox_w', 'bbox_h', 'components']
+
+
+def mask_report_row(img_path, mask_format, size=None, full_ratio=0.99):
+    # 和界面一样按文件名配对: mask/图片名.当前格式, 没有的话再找其他格式
+    row = dict.fromkeys(REPORT_FIELDS, '')
+    row['image'] = img_path.name
+    problems = []
+
+    mask_img_path = find_mask_img_path(img_path, mask_format)
+    if not mask_img_path.exists():
+        row['status'] = 'missing'
+        return row
+
+    row['mask'] = mask_img_path.name
+    img = read_mask_image(mask_img_path)
+    if img.isNull():
+        row['status'] = 'unreadable'
+        return row
+
+    foreground = mask_foreground(img)
+    h, w = foreground.shape
+    pixels = int(np.count_nonzero(foreground))
+    row.update(width=w, height=h, mask_pixels=pixels, coverage=round(pixels / float(w * h), 6))
+
+    expected_size = QSize(*size) if size is not None else image_native_size(img_path)
+    if not expected_size.isEmpty() and img.size() != expected_size:
+        problems.append('size_mismatch')
+
+    if pixels == 0:
+        row.update(status='empty', components=0)
+    else:
+        ys = np.flatnonzero(foreground.any(axis=1))
+        xs = np.flatnonzero(foreground.any(axis=0))
+        _, count = label_components(foreground)
+        row.update(status='full' if pixels >= full_ratio * w * h else 'annotated',
+                   bbox_x=int(xs[0]), bbox_y=int(ys[0]), bbox_w=int(xs[-1] - xs[0] + 1), bbox_h=int(ys[-1] - ys[0] + 1),
+                   components=count)
+
+    row['problems'] = ';'.join(problems)
+    return row
+
+
+def report_chunk(img_files, mask_format, size, full_ratio):
+    rows = []
+    for img_path in img_files:
+        try:
+            rows.append(mask_report_row(img_path, mask_format, size, full_ratio))
+        except:
+            logging.exception(f'report {img_path} exception')
+            row = dict.fromkeys(REPORT_FIELDS, '')
+            row.update(image=img_path.name, status='unreadable')
+            rows.append(row)
+    return rows
+
+
+def report_dataset(directory, mask_format='bmp', size=(512, 512), csv_path=None, json_path=None,
+                   full_ratio=0.99, workers=None, chunk_size=256):
+    # 每个进程只返回一小段的统计结果, 主进程边收边写, 同时在途的分段数有上限, 内存占用和图片数量无关
+    directory = Path(directory)
+    all_img_file = list_img_files(directory)
+
+    stems = {}
+    for img_path in all_img_file:
+        stems.setdefault(img_path.stem, []).append(img_path.name)
+    mask_dir = directory.joinpath('mask')
+    mask_stems = {}
+    if mask_dir.is_dir():
+        with os.scandir(str(mask_dir)) as it:
+            for entry in it:
+                name, suffix = os.path.splitext(entry.name)
+                if suffix.lower() in MASK_FORMAT_SUFFIXES.values() and entry.is_file():
+                    mask_stems.setdefault(name, []).append(entry.name)
+    orphans = sorted(x for stem in mask_stems if stem not in stems for x in mask_stems[stem])
+
+    summary = {'images': len(all_img_file), 'missing': 0, 'unreadable': 0, 'empty': 0, 'full': 0, 'annotated': 0,
+               'orphan': len(orphans), 'size_mismatch': 0, 'shared_mask': 0, 'multiple_masks': 0, 'mask_pixels': 0}
+
+    csv_file = open(csv_path, 'w', newline='', encoding='utf-8') if csv_path else None
+    json_file = open(json_path, 'w', encoding='utf-8') if json_path else None
+    try:
+        writer = None
+        if csv_file:
+            writer = csv.DictWriter(csv_file, REPORT_FIELDS)
+            writer.writeheader()
+        if json_file:
+            json_file.write('{"images": [')
+        first = True
+
+        def write_row(row):
+            nonlocal first
+            if writer:
+                writer.writerow(row)
+            if json_file:
+                json_file.write(('\n' if first else ',\n') + json.dumps(row, ensure_ascii=False))
+                first = False
+
+        def add_rows(rows):
+            for row in rows:
+                problems = [x for x in row['problems'].split(';') if x]
+                stem = os.path.splitext(row['image'])[0]
+                if len(stems[stem]) > 1:
+                    problems.append('shared_mask')
+                if len(mask_stems.get(stem, [])) > 1:
+                    problems.append('multiple_masks')
+                row['problems'] = ';'.join(problems)
+
+                summary[row['status']] += 1
+                summary['mask_pixels'] += row['mask_pixels'] or 0
+                for problem in problems:
+                    summary[problem] += 1
+                write_row(row)
+
+        workers = workers or os.cpu_count() or 1
+        pending = deque()
+        done = 0
+        with ProcessPoolExecutor(workers) as executor:
+            for i in range(0, len(all_img_file), chunk_size):
+                pending.append(executor.submit(report_chunk, all_img_file[i:i + chunk_size], mask_format, size, full_ratio))
+                while len(pending) > workers * 2 or (pending and i + chunk_size >= len(all_img_file)):
+                    rows = pending.popleft().result()
+                    add_rows(rows)
+                    done += len(rows)
+                    print(f'\r{done}/{len(all_img_file)}', end='', flush=True)
+
+        for name in orphans:
+            row = dict.fromkeys(REPORT_FIELDS, '')
+            row.update(mask=name, status='orphan')
+            write_row(row)
+
+        if json_file:
+            json_file.write('\n], "summary": ' + json.dumps(summary, ensure_ascii=False) + '}\n')
+    finally:
+        if csv_file:
+            csv_file.close()
+        if json_file:
+            json_file.close()
+
+    print(f'\n检查完成: {summary}')
+    return summary
+
+
+def mask_stats(img):
+    foreground = mask_foreground(img)
+    pixels = int(np.count_nonzero(foreground))
+    mask_hash = hashlib.sha1(np.packbits(foreground).tobytes() + bytes(f'{foreground.shape}', 'ascii')).hexdigest()
+    return pixels, mask_hash
+
+
+def image_cache_key(kind, path, size=None):
+    try:
+        st = os.stat(str(path))
+    except OSError:
+        return None
+
+    if size is not None:
+        size = (size.width(), size.height())
+    return (kind, str(path), st.st_mtime_ns, st.st_size, size)
+
+
+def load_cache_image(kind, path, size=None):
+    if kind == 'mask':
+        img = read_mask_image(path)
+        return to_mask_image(img) if not img.isNull() else img
+    return load_image(path, size)
+
+
+@profiled('decode')
+def load_image(path, size=None):
+    reader = QImageReader(str(path))
+    # 旋转jpeg时只修改EXIF方向, 读取时按EXIF方向显示
+    reader.setAutoTransform(True)
+    if size is not None:
+        # jpeg等格式支持在解码时直接缩小, 不需要先解码出完整分辨率的图片
+        reader.setScaledSize(size)
+
+    img = reader.read()
+    if not img.isNull() and size is not None and img.size() != size:
+        img = img.scaled(size)
+    return img
+
+
+class ImageCache(object):
+    # 按最近最少使用淘汰的解码图片缓存, 可以在多个线程中使用
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.items = OrderedDict()
+        self.wanted = set()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            img = self.items.get(key)
+            if img is not None:
+                self.items.move_to_end(key)
+            return img
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.items
+
+    def put(self, key, img):
+        nbytes = img.sizeInBytes()
+        if nbytes > self.max_bytes:
+            return
+
+        with self.lock:
+            old_img = self.items.pop(key, None)
+            if old_img is not None:
+                self.total_bytes -= old_img.sizeInBytes()
+
+            self.items[key] = img
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, old_img = self.items.popitem(last=False)
+                self.total_bytes -= old_img.sizeInBytes()
+
+    def discard(self, path):
+        path = str(path)
+        with self.lock:
+            for key in [x for x in self.items if x[1] == path]:
+                self.total_bytes -= self.items.pop(key).sizeInBytes()
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.wanted.clear()
+            self.total_bytes = 0
+
+    def set_wanted(self, paths):
+        with self.lock:
+            self.wanted = set(str(x) for x in paths)
+
+    def is_wanted(self, path):
+        with self.lock:
+            return str(path) in self.wanted
+
+    def load(self, kind, path, size=None):
+        key = image_cache_key(kind, path, size)
+        if key is None:
+            return None
+
+        img = self.get(key)
+        if img is None:
+            img = load_cache_image(kind, path, size)
+            if img.isNull():
+                return None
+            self.put(key, img)
+        return img
+
+
+class ImageLoadTask(QtCore.QRunnable):
+    # 在线程池中预先解码相邻的图片和mask
+    def __init__(self, cache, kind, path, size=None):
+        super(ImageLoadTask, self).__init__()
+
+        self.cache = cache
+        self.kind = kind
+        self.path = path
+        self.size = size
+
+    def run(self):
+        try:
+            if not self.cache.is_wanted(self.path):
+                return
+
+            key = image_cache_key(self.kind, self.path, self.size)
+            if key is None or self.cache.contains(key):
+                return
+
+            img = load_cache_image(self.kind, self.path, self.size)
+            if not img.isNull():
+                self.cache.put(key, img)
+        except:
+            logging.exception(f'prefetch {self.path} exception')
+
+
+class NavLoadTask(QtCore.QRunnable):
+    # 翻页时在后台解码目标图片和mask, 完成后由界面线程显示
+    def __init__(self, cache, img_path, mask_img_path, size, generation, callback):
+        super(NavLoadTask, self).__init__()
+
+        self.cache = cache
+        self.img_path = img_path
+        self.mask_img_path = mask_img_path
+        self.size = size
+        self.generation = generation
+        self.callback = callback
+
+    def run(self):
+        try:
+            self.cache.load('img', self.img_path, self.size)
+            if self.mask_img_path.exists():
+                self.cache.load('mask', self.mask_img_path)
+        except:
+            logging.exception(f'load {self.img_path} exception')
+        self.callback(self.generation)
+
+
+class MaskIndex(object):
+    # 保存在图片目录下的sqlite索引, 记录每张图片的标注状态, 避免每次都去解码所有mask
+    STATUS_MISSING = 'missing'
+    STATUS_EMPTY = 'empty'
+    STATUS_ANNOTATED = 'annotated'
+
+    def __init__(self, directory, mask_format='bmp'):
+        self.directory = Path(directory)
+        self.mask_format = mask_format
+        self.db_path = get_data_path(self.directory, 'mask_index.db')
+        self.lock = threading.RLock()
+        self.canceled = False
+
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                name TEXT PRIMARY KEY,
+                stem TEXT,
+                mtime_ns INTEGER,
+                size INTEGER,
+                mask_status TEXT,
+                mask_pixels INTEGER,
+                mask_hash TEXT,
+                mask_mtime_ns INTEGER,
+                mask_size INTEGER
+            )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS images_stem ON images (stem)')
+        self.conn.commit()
+
+        self.status = {}
+        self.stem_names = {}
+        self.annotated_count = 0
+        for name, stem, mask_status in self.conn.execute('SELECT name, stem, mask_status FROM images'):
+            self.set_status(name, stem, mask_status)
+
+    def close(self):
+        with self.lock:
+            self.canceled = True
+            self.conn.close()
+
+    def set_status(self, name, stem, mask_status):
+        old_status = self.status.get(name)
+        if old_status == self.STATUS_ANNOTATED:
+            self.annotated_count -= 1
+        if mask_status == self.STATUS_ANNOTATED:
+            self.annotated_count += 1
+
+        self.status[name] = mask_status
+        self.stem_names.setdefault(stem, set()).add(name)
+
+    def remove_status(self, name, stem):
+        if self.status.pop(name, None) == self.STATUS_ANNOTATED:
+            self.annotated_count -= 1
+        self.stem_names.get(stem, set()).discard(name)
+
+    def get_status(self, img_path):
+        with self.lock:
+            return self.status.get(img_path.name)
+
+    def is_annotated(self, img_path):
+        return self.get_status(img_path) == self.STATUS_ANNOTATED
+
+    def read_mask_record(self, mask_path, img=None):
+        try:
+            st = os.stat(str(mask_path))
+        except OSError:
+            return self.STATUS_MISSING, 0, None, None, None
+
+        if img is None:
+            img = read_mask_image(mask_path)
+        if img.isNull():
+            return self.STATUS_MISSING, 0, None, st.st_mtime_ns, st.st_size
+
+        pixels, mask_hash = mask_stats(img)
+        mask_status = self.STATUS_ANNOTATED if pixels > 0 else self.STATUS_EMPTY
+        return mask_status, pixels, mask_hash, st.st_mtime_ns, st.st_size
+
+    def update_mask(self, mask_path, img=None):
+        mask_path = Path(mask_path)
+        stem = mask_path.stem
+        record = self.read_mask_record(mask_path, img)
+
+        with self.lock:
+            if self.canceled:
+                return
+            self.conn.execute('''
+                UPDATE images SET mask_status=?, mask_pixels=?, mask_hash=?, mask_mtime_ns=?, mask_size=?
+                WHERE stem=?''', record + (stem,))
+            self.conn.commit()
+            for name in self.stem_names.get(stem, set()):
+                self.set_status(name, stem, record[0])
+
+    def sync(self, all_img_file, removed=None):
+        # 只重新计算图片或mask的修改时间/大小有变化的记录
+        # 给出removed时只同步all_img_file里的图片并删除removed里的记录, 用于目录监视的增量更新
+        with self.lock:
+            rows = {}
+            for row in self.conn.execute('SELECT name, mtime_ns, size, mask_mtime_ns, mask_size FROM images'):
+                rows[row[0]] = row[1:]
+
+        names = set()
+        changed = []
+        for img_path in all_img_file:
+            if self.canceled:
+                return
+
+            names.add(img_path.name)
+            try:
+                st = img_path.stat()
+            except OSError:
+                continue
+
+            mask_path = find_mask_img_path(img_path, self.mask_format)
+            try:
+                mst = mask_path.stat()
+                mask_key = (mst.st_mtime_ns, mst.st_size)
+            except OSError:
+                mask_key = (None, None)
+
+            if rows.get(img_path.name) == (st.st_mtime_ns, st.st_size) + mask_key:
+                continue
+
+            record = self.read_mask_record(mask_path)
+            changed.append((img_path.name, img_path.stem, st.st_mtime_ns, st.st_size) + record)
+            if len(changed) >= 500:
+                self.write_records(changed)
+                changed = []
+
+        self.write_records(changed)
+
+        if removed is None:
+            removed = [x for x in rows if x not in names]
+        with self.lock:
+            if self.canceled:
+                return
+            self.conn.executemany('DELETE FROM images WHERE name=?', [(x,) for x in removed])
+            self.conn.commit()
+            for name in removed:
+                self.remove_status(name, Path(name).stem)
+
+    def write_records(self, records):
+        with self.lock:
+            if self.canceled or not records:
+                return
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO images
+                (name, stem, mtime_ns, size, mask_status, mask_pixels, mask_hash, mask_mtime_ns, mask_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', records)
+            self.conn.commit()
+            for record in records:
+                self.set_status(record[0], record[1], record[4])
+
+
+class MaskIndexSyncTask(QtCore.QRunnable):
+    def __init__(self, mask_index, all_img_file, removed=None):
+        super(MaskIndexSyncTask, self).__init__()
+
+        self.mask_index = mask_index
+        self.all_img_file = list(all_img_file)
+        self.removed = removed
+
+    def run(self):
+        try:
+            self.mask_index.sync(self.all_img_file, self.removed)
+        except:
+            logging.exception(f'sync {self.mask_index.db_path} exception')
+
+
+class MaskIndexUpdateTask(QtCore.QRunnable):
+    # 保存mask之后在后台统计像素, 计算哈希并写入索引, 完成后通知界面线程刷新状态
+    def __init__(self, mask_index, mask_img_path, mask_img, callback):
+        super(MaskIndexUpdateTask, self).__init__()
+
+        self.mask_index = mask_index
+        self.mask_img_path = mask_img_path
+        self.mask_img = mask_img
+        self.callback = callback
+
+    def run(self):
+        try:
+            self.mask_index.update_mask(self.mask_img_path, self.mask_img)
+        except:
+            logging.exception(f'update {self.mask_index.db_path} exception')
+        self.callback()
+
+
+class ThumbnailCache(QtCore.QObject):
+    # 缩略图保存在图片目录下的定长分块文件里, 用内存映射读写, sqlite记录每张图片对应的分块
+    # 每个分块是缩略图的RGB数据加上缩小后的mask, 只有mask变化时不需要重新解码原图
+    ready = QtCore.Signal(object, object)
+
+    def __init__(self, directory, mask_format='bmp', thumb_size=96, parent=None):
+        super(ThumbnailCache, self).__init__(parent)
+
+        self.directory = Path(directory)
+        self.mask_format = mask_format
+        self.thumb_size = thumb_size
+        self.slot_bytes = thumb_size * thumb_size * 4
+        self.overlay_color = QColor(255, 255, 0)
+        self.overlay_opacity = 0.5
+        self.lock = threading.Lock()
+        self.closed = False
+        self.unsaved = 0
+
+        self.db_path = get_data_path(self.directory, f'thumb_cache_{thumb_size}.db')
+        self.atlas_path = get_data_path(self.directory, f'thumb_cache_{thumb_size}.bin')
+
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS thumbs (
+                name TEXT PRIMARY KEY,
+                mtime_ns INTEGER,
+                size INTEGER,
+                mask_mtime_ns INTEGER,
+                slot INTEGER
+            )''')
+        self.conn.commit()
+
+        self.records = {}
+        for name, mtime_ns, size, mask_mtime_ns, slot in self.conn.execute('SELECT * FROM thumbs'):
+            self.records[name] = (mtime_ns, size, mask_mtime_ns, slot)
+        self.slot_count = max([x[3] for x in self.records.values()], default=-1) + 1
+
+        self.atlas = None
+        self.atlas_path.touch()
+        self.map_atlas(max(1024, self.slot_count))
+
+    def map_atlas(self, capacity):
+        self.atlas = None
+        if os.path.getsize(str(self.atlas_path)) < capacity * self.slot_bytes:
+            with open(str(self.atlas_path), 'r+b') as f:
+                f.truncate(capacity * self.slot_bytes)
+        self.capacity = capacity
+        self.atlas = np.memmap(str(self.atlas_path), np.uint8, 'r+', shape=(capacity, self.slot_bytes))
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.atlas.flush()
+            self.atlas = None
+            self.conn.commit()
+            self.conn.close()
+
+    def file_key(self, img_path):
+        st = os.stat(str(img_path))
+        mask_path = find_mask_img_path(img_path, self.mask_format)
+        try:
+            mask_mtime_ns = os.stat(str(mask_path)).st_mtime_ns
+        except OSError:
+            mask_path = None
+            mask_mtime_ns = 0
+        return st.st_mtime_ns, st.st_size, mask_mtime_ns, mask_path
+
+    def load(self, img_path):
+        mtime_ns, size, mask_mtime_ns, mask_path = self.file_key(img_path)
+        t = self.thumb_size
+
+        with self.lock:
+            if self.closed:
+                return None
+            record = self.records.get(img_path.name)
+            if record is not None and record[:2] == (mtime_ns, size):
+                slot = record[3]
+                data = np.array(self.atlas[slot])
+            else:
+                slot = record[3] if record is not None else None
+                record = None
+                data = None
+
+        if data is None:
+            img = load_image(img_path, QSize(t, t))
+            if img.isNull():
+                return None
+            data = np.zeros(self.slot_bytes, np.uint8)
+            data[:t * t * 3] = image_to_rgb_array(img).ravel()
+
+        if record is None or record[2] != mask_mtime_ns:
+            foreground = np.zeros((t, t), bool)
+            if mask_path is not None:
+                mask_img = read_mask_image(mask_path)
+                if not mask_img.isNull():
+                    foreground = mask_foreground(resample_mask_image(mask_img, QSize(t, t)))
+            data[t * t * 3:] = foreground.ravel()
+
+            with self.lock:
+                if self.closed:
+                    return None
+                if slot is None:
+                    slot = self.slot_count
+                    self.slot_count += 1
+                    if slot >= self.capacity:
+                        self.map_atlas(self.capacity * 2)
+                self.atlas[slot] = data
+                self.records[img_path.name] = (mtime_ns, size, mask_mtime_ns, slot)
+                self.conn.execute('INSERT OR REPLACE INTO thumbs VALUES (?, ?, ?, ?, ?)',
+                                  (img_path.name, mtime_ns, size, mask_mtime_ns, slot))
+                self.unsaved += 1
+                if self.unsaved >= 64:
+                    self.conn.commit()
+                    self.unsaved = 0
+
+        return self.compose(data)
+
+    def compose(self, data):
+        # 和标注界面一样用颜色表按画笔颜色和不透明度把mask画在缩略图上
+        t = self.thumb_size
+        img = QImage(t, t, QImage.Format_RGB32)
+        arr = qimage_to_array(img, writable=True)
+        arr[:, :, :3] = data[:t * t * 3].reshape(t, t, 3)[:, :, ::-1]
+        arr[:, :, 3] = 255
+
+        foreground = data[t * t * 3:].reshape(t, t).astype(bool)
+        if foreground.any():
+            mask_img = foreground_to_mask_image(foreground)
+            overlay = indexed_mask_view(mask_img, mask_img.rect(), mask_color_table(self.overlay_color, self.overlay_opacity))
+            painter = QPainter(img)
+            painter.drawImage(0, 0, overlay)
+            painter.end()
+        return img
+
+
+class ThumbnailLoadTask(QtCore.QRunnable):
+    def __init__(self, cache, img_path):
+        super(ThumbnailLoadTask, self).__init__()
+
+        self.cache = cache
+        self.img_path = img_path
+
+    def run(self):
+        try:
+            img = self.cache.load(self.img_path)
+        except:
+            logging.exception(f'load thumbnail {self.img_path} exception')
+            img = None
+        self.cache.ready.emit(self.img_path, img)
+
+
+class ThumbnailModel(QtCore.QAbstractListModel):
+    # 列表视图只会请求可见项的数据, 所以只有可见的缩略图会被加载
+    def __init__(self, pool, max_count=2000, parent=None):
+        super(ThumbnailModel, self).__init__(parent)
+
+        self.pool = pool
+        self.cache = None
+        self.img_files = []
+        self.rows = {}
+        self.thumbs = OrderedDict()
+        self.loading = set()
+        self.max_count = max_count
+
+    def set_cache(self, cache):
+        self.clear_pending()
+        if self.cache is not None:
+            self.cache.ready.disconnect(self.on_thumbnail_ready)
+        self.cache = cache
+        if self.cache is not None:
+            self.cache.ready.connect(self.on_thumbnail_ready)
+        self.thumbs.clear()
+
+    def set_img_files(self, img_files):
+        self.beginResetModel()
+        self.img_files = list(img_files)
+        self.rows = None
+        self.endResetModel()
+
+    def insert_img_file(self, row, img_path):
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.img_files.insert(row, img_path)
+        self.rows = None
+        self.endInsertRows()
+
+    def remove_img_file(self, row):
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        self.thumbs.pop(self.img_files.pop(row), None)
+        self.rows = None
+        self.endRemoveRows()
+
+    def refresh(self):
+        # 标注颜色或不透明度变化后重新合成所有缩略图
+        self.thumbs.clear()
+        if self.img_files:
+            self.dataChanged.emit(self.index(0), self.index(len(self.img_files) - 1), [Qt.DecorationRole])
+
+    def row_of(self, img_path):
+        # 增删行之后不马上重建行号表, 等到需要时再重建
+        if self.rows is None:
+            self.rows = {x: i for i, x in enumerate(self.img_files)}
+        return self.rows.get(img_path)
+
+    def clear_pending(self):
+        # 快速滚动时丢掉已经不可见的加载任务, 重绘时会重新请求可见的缩略图
+        self.pool.clear()
+        self.loading.clear()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.img_files)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.img_files):
+            return None
+
+        img_path = self.img_files[index.row()]
+        if role == Qt.DecorationRole:
+            thumb = self.thumbs.get(img_path)
+            if thumb is not None:
+                self.thumbs.move_to_end(img_path)
+                return thumb
+            if self.cache is not None and img_path not in self.loading:
+                self.loading.add(img_path)
+                self.pool.start(ThumbnailLoadTask(self.cache, img_path))
+            return None
+        if role == Qt.ToolTipRole:
+            return f'{index.row() + 1}: {img_path.name}'
+        return None
+
+    def on_thumbnail_ready(self, img_path, img):
+        self.loading.discard(img_path)
+        row = self.row_of(img_path)
+        if img is None or row is None:
+            return
+
+        self.thumbs[img_path] = QPixmap.fromImage(img)
+        while len(self.thumbs) > self.max_count:
+            self.thumbs.popitem(last=False)
+
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def invalidate_stem(self, stem):
+        for img_path in [x for x in self.thumbs if x.stem == stem]:
+            del self.thumbs[img_path]
+            row = self.row_of(img_path)
+            if row is None:
+                continue
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class ImagePyramid(QtCore.QObject):
+    # 原图的多级分块金字塔, 只在放大查看时按需在后台解码可见的分块
+    tile_ready = QtCore.Signal()
+
+    def __init__(self, path, cache, pool, tile_size=256, parent=None):
+        super(ImagePyramid, self).__init__(parent)
+
+        self.path = path
+        self.cache = cache
+        self.pool = pool
+        self.tile_size = tile_size
+        self.active = True
+        self.loading = set()
+        self.lock = threading.Lock()
+        self.level_locks = {}
+        self.last_level = None
+
+        reader = QImageReader(str(path))
+        reader.setAutoTransform(True)
+        self.size = image_native_size(path)
+        # 支持按区域解码并且不需要旋转的格式(jpeg)直接解码分块, 其他格式先解码整层再切块
+        self.tiled = reader.supportsOption(QImageIOHandler.ClipRect) and reader.transformation() == QImageIOHandler.TransformationNone
+        self.key_base = image_cache_key('tile', path)
+
+        self.levels = 1
+        while max(self.size.width(), self.size.height()) >> self.levels > tile_size:
+            self.levels += 1
+
+    def level_size(self, level):
+        return QSize(max(1, self.size.width() >> level), max(1, self.size.height() >> level))
+
+    def choose_level(self, img_scale):
+        # img_scale: 每个原图像素对应的屏幕像素数
+        level = 0
+        while level + 1 < self.levels and img_scale <= 1.0 / (2 ** (level + 1)):
+            level += 1
+        return level
+
+    def tile_rect(self, level, tx, ty):
+        return QRect(tx * self.tile_size, ty * self.tile_size, self.tile_size, self.tile_size).intersected(QRect(QPoint(0, 0), self.level_size(level)))
+
+    def tile_key(self, level, tx, ty):
+        return self.key_base + ((level, tx, ty),)
+
+    def visible_tiles(self, level, rect):
+        # rect: 原图坐标下的可见区域
+        scale = 2 ** level
+        left = max(0, int(rect.left() / scale) // self.tile_size)
+        top = max(0, int(rect.top() / scale) // self.tile_size)
+        size = self.level_size(level)
+        right = min((size.width() - 1) // self.tile_size, int(rect.right() / scale) // self.tile_size)
+        bottom = min((size.height() - 1) // self.tile_size, int(rect.bottom() / scale) // self.tile_size)
+        for ty in range(top, bottom + 1):
+            for tx in range(left, right + 1):
+                yield tx, ty
+
+    def get_tile(self, level, tx, ty):
+        if self.key_base is None:
+            return None
+
+        key = self.tile_key(level, tx, ty)
+        img = self.cache.get(key)
+        if img is None:
+            with self.lock:
+                if key not in self.loading:
+                    self.loading.add(key)
+                    self.pool.start(TileLoadTask(self, level, tx, ty))
+        return img
+
+    def load_level(self, level):
+        # 同一层的多个分块同时缺失时只解码一次整层, 其他线程等待解码完成后直接切块
+        with self.lock:
+            level_lock = self.level_locks.setdefault(level, threading.Lock())
+
+        with level_lock:
+            last_level = self.last_level
+            if last_level is not None and last_level[0] == level:
+                return last_level[1]
+
+            level_key = self.key_base + ((level,),)
+            level_img = self.cache.get(level_key)
+            if level_img is None:
+                level_img = load_image(self.path, self.level_size(level))
+                self.cache.put(level_key, level_img)
+            # 整层图片可能比缓存上限还大, 放不进缓存, 所以再保留最近用到的一层
+            self.last_level = (level, level_img)
+            return level_img
+
+    def load_tile(self, level, tx, ty):
+        key = self.tile_key(level, tx, ty)
+        try:
+            if not self.active:
+                return
+
+            rect = self.tile_rect(level, tx, ty)
+            if self.tiled:
+                reader = QImageReader(str(self.path))
+                if level == 0:
+                    reader.setClipRect(rect)
+                else:
+                    reader.setScaledSize(self.level_size(level))
+                    reader.setScaledClipRect(rect)
+                img = reader.read()
+            else:
+                img = self.load_level(level).copy(rect)
+
+            if not img.isNull():
+                self.cache.put(key, img)
+                self.tile_ready.emit()
+        finally:
+            with self.lock:
+                self.loading.discard(key)
+
+
+class TileLoadTask(QtCore.QRunnable):
+    def __init__(self, pyramid, level, tx, ty):
+        super(TileLoadTask, self).__init__()
+
+        self.pyramid = pyramid
+        self.level = level
+        self.tx = tx
+        self.ty = ty
+
+    def run(self):
+        try:
+            self.pyramid.load_tile(self.level, self.tx, self.ty)
+        except:
+            logging.exception(f'load tile {self.pyramid.path} exception')
+
+
+class UndoHistory(object):
+    # 每张图片各自的撤销/重做记录, 只保存每一步修改过的8位mask分块并压缩, 超过内存上限时丢弃最早的记录
+    def __init__(self, max_bytes=64 * 1024 * 1024, tile_size=64):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.total_bytes = 0
+        self.stacks = {}
+        self.entries = deque()
+
+    def diff_tiles(self, before, after):
+        a = mask_array(to_mask_image(before))
+        b = mask_array(to_mask_image(after))
+
+        tiles = []
+        h, w = a.shape[:2]
+        for y in range(0, h, self.tile_size):
+            for x in range(0, w, self.tile_size):
+                tile_a = a[y:y + self.tile_size, x:x + self.tile_size]
+                tile_b = b[y:y + self.tile_size, x:x + self.tile_size]
+                if np.array_equal(tile_a, tile_b):
+                    continue
+                tiles.append((x, y, tile_a.shape[1], tile_a.shape[0],
+                              zlib.compress(np.ascontiguousarray(tile_a).tobytes(), 1),
+                              zlib.compress(np.ascontiguousarray(tile_b).tobytes(), 1)))
+        return tiles
+
+    def grab_tile(self, img, x, y):
+        rect = QRect(x, y, self.tile_size, self.tile_size).intersected(img.rect())
+        tile = mask_array(img)[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+        return rect.width(), rect.height(), zlib.compress(np.ascontiguousarray(tile).tobytes(), 1)
+
+    def tiles_of(self, rect):
+        rect = QRect(rect)
+        for y in range(max(0, rect.top()) // self.tile_size * self.tile_size, rect.bottom() + 1, self.tile_size):
+            for x in range(max(0, rect.left()) // self.tile_size * self.tile_size, rect.right() + 1, self.tile_size):
+                yield x, y
+
+    def push(self, key, before, after):
+        if before.size() != after.size():
+            self.clear(key)
+            return
+
+        self.push_tiles(key, self.diff_tiles(before, after))
+
+    def push_tiles(self, key, tiles):
+        if not tiles:
+            return
+
+        entry = {'key': key, 'tiles': tiles, 'bytes': sum(len(x[4]) + len(x[5]) for x in tiles)}
+        undo_stack, redo_stack = self.stacks.setdefault(key, ([], []))
+        for old_entry in redo_stack:
+            self.remove_entry(old_entry)
+        redo_stack.clear()
+
+        undo_stack.append(entry)
+        self.entries.append(entry)
+        self.total_bytes += entry['bytes']
+
+        while self.total_bytes > self.max_bytes and self.entries:
+            old_entry = self.entries[0]
+            undo_stack, redo_stack = self.stacks[old_entry['key']]
+            if old_entry in undo_stack:
+                undo_stack.remove(old_entry)
+            if old_entry in redo_stack:
+                redo_stack.remove(old_entry)
+            self.remove_entry(old_entry)
+
+    def remove_entry(self, entry):
+        self.entries.remove(entry)
+        self.total_bytes -= entry['bytes']
+
+    def clear(self, key=None):
+        keys = list(self.stacks) if key is None else [key]
+        for key in keys:
+            undo_stack, redo_stack = self.stacks.pop(key, ([], []))
+            for entry in undo_stack + redo_stack:
+                self.remove_entry(entry)
+
+    def can_undo(self, key):
+        return bool(self.stacks.get(key, ([], []))[0])
+
+    def can_redo(self, key):
+        return bool(self.stacks.get(key, ([], []))[1])
+
+    def apply(self, target, entry, use_after):
+        arr = mask_array(target, writable=True)
+        dirty_rect = QRect()
+        for x, y, w, h, before_data, after_data in entry['tiles']:
+            data = zlib.decompress(after_data if use_after else before_data)
+            arr[y:y + h, x:x + w] = np.frombuffer(data, np.uint8).reshape(h, w)
+            dirty_rect = dirty_rect.united(QRect(x, y, w, h))
+        return dirty_rect
+
+    def undo(self, key, target):
+        undo_stack, redo_stack = self.stacks.get(key, ([], []))
+        if not undo_stack:
+            return None
+
+        entry = undo_stack.pop()
+        redo_stack.append(entry)
+        return self.apply(target, entry, False)
+
+    def redo(self, key, target):
+        undo_stack, redo_stack = self.stacks.get(key, ([], []))
+        if not redo_stack:
+            return None
+
+        entry = redo_stack.pop()
+        undo_stack.append(entry)
+        return self.apply(target, entry, True)
+
+
+class StrokeEngine(QtCore.QObject):
+    # 收集鼠标移动采样点, 每帧合并成一段连续路径绘制到mask上
+    about_to_paint = QtCore.Signal(QRect)
+    painted = QtCore.Signal(QRect)
+
+    def __init__(self, parent=None, flush_interval=8):
+        super(StrokeEngine, self).__init__(parent)
+
+        self.target = None
+        self.pen = None
+        self.last_point = None
+        self.pending_points = []
+
+        self.flush_timer = QtCore.QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(flush_interval)
+        self.flush_timer.timeout.connect(self.flush)
+
+    def begin_stroke(self, target, pen, point):
+        self.end_stroke()
+
+        self.target = target
+        self.pen = pen
+        self.last_point = None
+        self.pending_points = [point]
+        self.flush()
+
+    def set_pen(self, pen):
+        if self.pen is not None and pen != self.pen:
+            self.flush()
+        self.pen = pen
+
+    def add_point(self, point):
+        if self.target is None:
+            return
+
+        self.pending_points.append(point)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def end_stroke(self):
+        self.flush()
+        self.target = None
+        self.pen = None
+        self.last_point = None
+
+    def flush(self):
+        self.flush_timer.stop()
+
+        if self.target is None or not self.pending_points:
+            self.pending_points = []
+            return
+
+        points = self.pending_points
+        self.pending_points = []
+
+        if self.last_point is None:
+            path_points = points
+        else:
+            path_points = [self.last_point] + points
+
+        xs = [point.x() for point in path_points]
+        ys = [point.y() for point in path_points]
+        r = self.pen.widthF() / 2 + 2
+        dirty_rect = QRectF(QPointF(min(xs) - r, min(ys) - r), QPointF(max(xs) + r, max(ys) + r)).toAlignedRect()
+        self.about_to_paint.emit(dirty_rect)
+
+        pp = QPainter(self.target)
+        pp.setPen(self.pen)
+        if self.last_point is None:
+            pp.drawPoint(points[0])
+
+        if len(path_points) > 1:
+            path = QPainterPath(path_points[0])
+            for point in path_points[1:]:
+                path.lineTo(point)
+            pp.drawPath(path)
+        pp.end()
+
+        self.last_point = points[-1]
+        self.painted.emit(dirty_rect)
+
+
+class MaskSaver(QtCore.QThread):
+    # 后台保存mask, 同一个文件的多次保存请求会被合并, 先写临时文件再原子替换
+    saved = QtCore.Signal(str, object)
+    failed = QtCore.Signal(str, str)
+
+    def __init__(self, parent=None, delay=0.5):
+        super(MaskSaver, self).__init__(parent)
+
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.writing_path = None
+        self.writing_img = None
+        self.flushing = False
+        self.stopping = False
+
+    def save(self, path, img, mask_format='bmp', color=None):
+        path = str(path)
+        with self.cond:
+            if path in self.pending:
+                self.pending[path] = (img, self.pending[path][1], mask_format, color)
+            else:
+                self.pending[path] = (img, time.monotonic(), mask_format, color)
+            self.cond.notify_all()
+
+    def pending_image(self, path):
+        path = str(path)
+        with self.cond:
+            if path in self.pending:
+                return self.pending[path][0]
+            if path == self.writing_path:
+                return self.writing_img
+        return None
+
+    def flush(self, wait=False):
+        with self.cond:
+            self.flushing = True
+            self.cond.notify_all()
+            if wait:
+                while self.pending or self.writing_path is not None:
+                    self.cond.wait()
+
+    def stop(self):
+        self.flush()
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopping:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+
+                path = min(self.pending, key=lambda x: self.pending[x][1])
+                deadline = self.pending[path][1] + self.delay
+                while not self.flushing and not self.stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                img, _, mask_format, color = self.pending.pop(path)
+                self.writing_path = path
+                self.writing_img = img
+
+            try:
+                write_mask_image(path, img, mask_format, color)
+                self.saved.emit(path, img)
+            except Exception as e:
+                logging.exception(f'save mask {path} exception')
+                self.failed.emit(path, str(e))
+            finally:
+                with self.cond:
+                    self.writing_path = None
+                    self.writing_img = None
+                    if not self.pending:
+                        self.flushing = False
+                    self.cond.notify_all()
+
+
+class DirScanner(QtCore.QThread):
+    # 在后台线程中扫描目录, 找到的图片分批通知界面, 扫描结束后给出排好序的完整列表
+    found = QtCore.Signal(object)
+    done = QtCore.Signal(object, bool)
+
+    def __init__(self, directory, parent=None, batch_interval=0.1):
+        super(DirScanner, self).__init__(parent)
+
+        self.directory = directory
+        self.batch_interval = batch_interval
+        self.canceled = False
+
+    def cancel(self):
+        self.canceled = True
+
+    def run(self):
+        all_img_file = []
+        batch = []
+        last_emit_time = time.monotonic()
+        scan_start_time = time.perf_counter()
+
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if self.canceled:
+                        break
+
+                    if os.path.splitext(entry.name)[1].upper() not in IMG_SUFFIXES:
+                        continue
+
+                    try:
+                        # 大多数文件系统上is_file直接使用目录项里的类型信息, 不需要stat
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+
+                    batch.append(Path(entry.path))
+                    if len(all_img_file) == 0 or time.monotonic() - last_emit_time >= self.batch_interval:
+                        all_img_file.extend(batch)
+                        self.found.emit(batch)
+                        batch = []
+                        last_emit_time = time.monotonic()
+        except OSError:
+            logging.exception(f'scan {self.directory} exception')
+
+        if batch:
+            all_img_file.extend(batch)
+            self.found.emit(batch)
+
+        all_img_file.sort()
+        profiler.record('scan_dir', scan_start_time, time.perf_counter())
+        self.done.emit(all_img_file, self.canceled)
+
+
+class DirListTask(QtCore.QRunnable):
+    # 只比较文件名, 比较结果也在后台线程里算好, 界面线程只处理变化的部分,
+    # 新增的文件按Path排序(Windows上不区分大小写), 和图片列表的顺序保持一致
+    def __init__(self, watcher, directory, names):
+        super(DirListTask, self).__init__()
+
+        self.watcher = watcher
+        self.directory = directory
+        self.names = names
+
+    def run(self):
+        try:
+            with os.scandir(str(self.directory)) as it:
+                names = {x.name for x in it if os.path.splitext(x.name)[1].upper() in IMG_SUFFIXES and x.is_file()}
+        except OSError:
+            logging.exception(f'list {self.directory} exception')
+            self.watcher.listed.emit(self.directory, None, None)
+            return
+
+        directory = Path(self.directory)
+        added = sorted(directory.joinpath(x) for x in names - self.names)
+        removed = {directory.joinpath(x) for x in self.names - names}
+        self.watcher.listed.emit(self.directory, added, removed)
+
+
+class DirWatcher(QtCore.QObject):
+    # 监视打开的目录(Linux上由inotify通知), 一段时间内的变化合并成一批,
+    # 在后台线程里重新列出文件名(不stat不解码), 和上次的结果比较得到新增和删除的图片
+    changed = QtCore.Signal(object, object)
+    listed = QtCore.Signal(object, object, object)
+
+    def __init__(self, parent=None, batch_interval=500):
+        super(DirWatcher, self).__init__(parent)
+
+        self.directory = None
+        self.names = set()
+        self.listing = False
+        self.dirty = False
+
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(batch_interval)
+        self.timer.timeout.connect(self.list_files)
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.listed.connect(self.on_listed)
+
+    def watch(self, directory, img_files):
+        self.stop()
+        self.directory = directory
+        self.names = {x.name for x in img_files}
+        if not self.watcher.addPath(str(directory)):
+            logging.warning(f'watch {directory} failed')
+
+    def stop(self):
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+        self.timer.stop()
+        self.directory = None
+        self.names = set()
+        self.dirty = False
+
+    def wait(self):
+        self.pool.waitForDone()
+
+    def on_directory_changed(self, path):
+        # 不重新计时, 一直有文件写入时也能按固定间隔刷新
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def list_files(self):
+        if self.directory is None:
+            return
+        if self.listing:
+            self.dirty = True
+            return
+
+        self.listing = True
+        self.pool.start(DirListTask(self, self.directory, self.names))
+
+    def on_listed(self, directory, added, removed):
+        self.listing = False
+        if directory == self.directory and added is not None and (added or removed):
+            # 同一时间只有一个列目录任务, 任务结束后才会修改这个集合
+            self.names.difference_update(x.name for x in removed)
+            self.names.update(x.name for x in added)
+            self.changed.emit(added, removed)
+
+        if self.dirty:
+            self.dirty = False
+            self.list_files()
+
+
+class BatchRotateThread(QtCore.QThread):
+    # 在进程池中批量旋转图片和对应的mask
+    progress = QtCore.Signal(int, int)
+    done = QtCore.Signal(object)
+
+    def __init__(self, img_files, mask_format, workers=None, parent=None):
+        super(BatchRotateThread, self).__init__(parent)
+
+        self.img_files = list(img_files)
+        self.mask_format = mask_format
+        self.workers = workers
+
+    def run(self):
+        errors = []
+        try:
+            # 界面进程里有多个线程, 用spawn方式启动子进程, 避免fork带来的问题
+            with multiprocessing.get_context('spawn').Pool(self.workers) as pool:
+                jobs = pool.imap(functools.partial(rotate_file_pair, mask_format=self.mask_format), self.img_files, chunksize=16)
+                for i, error in enumerate(jobs):
+                    if error:
+                        errors.append(error)
+                    self.progress.emit(i + 1, len(self.img_files))
+        except Exception as e:
+            logging.exception('batch rotate exception')
+            errors.append(str(e))
+        self.done.emit(errors)
 
 
 class ImageLabel(QLabel):
@@ -23,17 +2222,36 @@ class ImageLabel(QLabel):
         self.label_img = None
         self.mask_img = None
         self.mask_img_path = None
+        self.mask_dirty = False
+        self.display_img = None
+        self.pyramid = None
 
         self.label_img_size = label_img_size
         self.img_rect = QRect(QPoint(0,0), QPoint(self.label_img_size.width(), self.label_img_size.height()))
 
-        self.mask_img = QPixmap(self.label_img_size)
-        self.mask_img.fill(QColor(255, 255, 255))
+        self.mask_img = new_mask_image(self.label_img_size)
+        self.mask_opacity = 0.5
+        self.mask_color_table = None
+
+        # 视图缩放: 每个mask像素对应的屏幕像素数, 以及视图左上角对应的mask坐标
+        self.view_scale = 1.0
+        self.view_offset = QPointF(0, 0)
+        self.max_view_scale = 16.0
 
         self.mouse_press_flag = False
         self.mouse_pos = None
+        self.pan_pos = None
+        self.input_time = None
+
+        self.stroke_engine = StrokeEngine(self)
+        self.stroke_engine.about_to_paint.connect(self.on_stroke_about_to_paint)
+        self.stroke_engine.painted.connect(self.on_stroke_painted)
+
+        self.undo_history = UndoHistory()
+        self.stroke_tiles = None
 
         self.eraser_painting_model = False
+        self.fill_model = False
         self.brush_pixle_size = 5
         self.eraser_pixle_size = 5
 
@@ -45,69 +2263,318 @@ class ImageLabel(QLabel):
 
         self.update_brush_pixle_size(self.brush_pixle_size)
         self.update_eraser_pixle_size(self.eraser_pixle_size)
+        self.update_mask_color_table()
 
         self.setCursor(self.brush_model_cursor)
 
+    def set_fill_model(self, fill_model):
+        self.fill_model = fill_model
+        if fill_model:
+            self.setCursor(Qt.CrossCursor)
+        else:
+            self.setCursor(self.eraser_model_cursor if self.eraser_painting_model else self.brush_model_cursor)
+
     def update_brush_color(self, color):
         self.brush_color = color
         self.update_brush_pixle_size(self.brush_pixle_size)
+        self.update_mask_color_table()
+
+    def update_mask_opacity(self, opacity):
+        self.mask_opacity = opacity
+        self.update_mask_color_table()
+
+    def update_mask_color_table(self):
+        self.mask_color_table = mask_color_table(self.brush_color, self.mask_opacity)
+        self.update_display_img()
+        self.update()
+
+    def cursor_pixle_size(self, pixle_size):
+        return max(1, min(256, int(round(pixle_size * self.view_scale))))
 
     def update_brush_pixle_size(self, pixle_size):
         self.brush_pixle_size = pixle_size
+        cursor_size = self.cursor_pixle_size(self.brush_pixle_size)
 
-        brush_cursor_pix = QPixmap(QSize(self.brush_pixle_size, self.brush_pixle_size))
+        brush_cursor_pix = QPixmap(QSize(cursor_size, cursor_size))
         brush_cursor_pix.fill(QColor(0, 0, 0))
         brush_cursor_pix_painter = QPainter(brush_cursor_pix)
         brush_cursor_pix_painter.setBrush(self.brush_color)
-        brush_cursor_pix_painter.drawEllipse(QRect(QPoint(-2,-2), QPoint(self.brush_pixle_size, self.brush_pixle_size)))
+        brush_cursor_pix_painter.drawEllipse(QRect(QPoint(-2,-2), QPoint(cursor_size, cursor_size)))
         brush_cursor_pix_painter.end()
         brush_cursor_pix.setMask(brush_cursor_pix.createMaskFromColor(self.brush_color, Qt.MaskOutColor))
 
         self.brush_model_cursor = QCursor(brush_cursor_pix)
 
-        if not self.eraser_painting_model:
+        if not self.eraser_painting_model and not self.fill_model:
             self.setCursor(self.brush_model_cursor)
 
     def update_eraser_pixle_size(self, pixle_size):
         self.eraser_pixle_size = pixle_size
+        cursor_size = self.cursor_pixle_size(self.eraser_pixle_size)
 
-        eraser_cursor_pix = QPixmap(QSize(self.eraser_pixle_size, self.eraser_pixle_size))
+        eraser_cursor_pix = QPixmap(QSize(cursor_size, cursor_size))
         eraser_cursor_pix.fill(QColor(255, 255, 255))
         eraser_cursor_pix_painter = QPainter(eraser_cursor_pix)
         eraser_cursor_pix_painter.setBrush(self.eraser_color)
-        eraser_cursor_pix_painter.drawEllipse(QRect(QPoint(-2,-2), QPoint(self.eraser_pixle_size, self.eraser_pixle_size)))
+        eraser_cursor_pix_painter.drawEllipse(QRect(QPoint(-2,-2), QPoint(cursor_size, cursor_size)))
         eraser_cursor_pix_painter.end()
         eraser_cursor_pix.setMask(eraser_cursor_pix.createMaskFromColor(self.eraser_color, Qt.MaskOutColor))
 
         self.eraser_model_cursor = QCursor(eraser_cursor_pix)
 
-        if self.eraser_painting_model:
+        if self.eraser_painting_model and not self.fill_model:
             self.setCursor(self.eraser_model_cursor)
 
-    def update_label_img(self, label_img, mask_img, mask_img_path):
+    def update_label_img(self, label_img, mask_img, mask_img_path, record_undo=False, pyramid=None):
+        self.stroke_engine.end_stroke()
+
+        before_img = None
+        if record_undo and self.mask_img_path == mask_img_path:
+            before_img = self.mask_img
+        keep_view = self.mask_img_path == mask_img_path and self.mask_img.size() == mask_img.size()
+
+        if self.pyramid is not None and self.pyramid is not pyramid:
+            self.pyramid.active = False
+            self.pyramid.tile_ready.disconnect(self.on_tile_ready)
+        if pyramid is not None and pyramid is not self.pyramid:
+            pyramid.tile_ready.connect(self.on_tile_ready)
+        self.pyramid = pyramid
+
         self.label_img = label_img.scaled(self.label_img_size)
-        self.mask_img = mask_img
-        self.mask_img.setMask(self.mask_img.createMaskFromColor(self.brush_color, Qt.MaskOutColor))
+        self.mask_img = to_mask_image(mask_img)
         self.mask_img_path = mask_img_path
+        self.mask_dirty = False
+
+        if keep_view:
+            self.update_display_img()
+            self.update()
+        else:
+            self.fit_view()
+
+        if before_img is not None:
+            self.undo_history.push(self.mask_img_path, before_img, self.mask_img)
+
+    def fit_view(self):
+        if not self.label_img:
+            return
+
+        mask_size = self.mask_img.size()
+        self.view_scale = min(self.label_img_size.width() / mask_size.width(), self.label_img_size.height() / mask_size.height())
+        self.view_offset = QPointF(0, 0)
+        self.clamp_view()
+        self.update_brush_pixle_size(self.brush_pixle_size)
+        self.update_eraser_pixle_size(self.eraser_pixle_size)
+        self.update_display_img()
+        self.update()
+
+    def zoom_view(self, factor, view_pos):
+        if not self.label_img:
+            return
+
+        mask_size = self.mask_img.size()
+        min_scale = min(self.label_img_size.width() / mask_size.width(), self.label_img_size.height() / mask_size.height())
+        scale = max(min_scale, min(self.max_view_scale, self.view_scale * factor))
+
+        # 保持鼠标下面的点不动
+        anchor = self.view_to_mask(view_pos)
+        local_pos = QPointF(view_pos - self.img_rect.topLeft())
+        self.view_scale = scale
+        self.view_offset = anchor - local_pos / scale
+        self.clamp_view()
+        self.update_brush_pixle_size(self.brush_pixle_size)
+        self.update_eraser_pixle_size(self.eraser_pixle_size)
+        self.update_display_img()
+        self.update()
+
+    def pan_view(self, delta):
+        self.view_offset = self.view_offset - QPointF(delta) / self.view_scale
+        self.clamp_view()
+        self.update_display_img()
+        self.update()
+
+    def clamp_view(self):
+        # mask比视图小的时候居中显示, 比视图大的时候不允许移出边界
+        mask_size = self.mask_img.size()
+        view_w = self.label_img_size.width() / self.view_scale
+        view_h = self.label_img_size.height() / self.view_scale
+
+        if view_w >= mask_size.width():
+            x = (mask_size.width() - view_w) / 2
+        else:
+            x = max(0, min(mask_size.width() - view_w, self.view_offset.x()))
+        if view_h >= mask_size.height():
+            y = (mask_size.height() - view_h) / 2
+        else:
+            y = max(0, min(mask_size.height() - view_h, self.view_offset.y()))
+        self.view_offset = QPointF(x, y)
+
+    def view_to_mask(self, pos):
+        return QPointF(pos - self.img_rect.topLeft()) / self.view_scale + self.view_offset
+
+    def mask_to_view_rect(self, rect):
+        return QRectF((QPointF(rect.topLeft()) - self.view_offset) * self.view_scale,
+                      QSize(rect.width(), rect.height()) * self.view_scale).toAlignedRect().adjusted(-1, -1, 1, 1)
+
+    def view_transform(self):
+        return QTransform(self.view_scale, 0, 0, self.view_scale,
+                          -self.view_offset.x() * self.view_scale, -self.view_offset.y() * self.view_scale)
+
+    def undo(self):
+        self.restore_history(self.undo_history.undo)
+
+    def redo(self):
+        self.restore_history(self.undo_history.redo)
+
+    def restore_history(self, restore):
+        if self.mouse_press_flag or not self.label_img:
+            return
+
+        self.save_mask_img()
+        dirty_rect = restore(self.mask_img_path, self.mask_img)
+        if dirty_rect is None:
+            return
+
+        self.mask_dirty = True
+        self.update_display_img(dirty_rect)
+        self.update()
+        self.save_mask_img()
+
+    def apply_mask_op(self, op):
+        # 整张mask作为numpy布尔数组做一次向量化运算, 结果写回mask并记录撤销
+        if self.mouse_press_flag or not self.label_img:
+            return
+
+        self.save_mask_img()
+        before_img = self.mask_img
+        self.mask_img = foreground_to_mask_image(op(mask_foreground(before_img)))
+
+        self.undo_history.push(self.mask_img_path, before_img, self.mask_img)
+        self.mask_dirty = True
+        self.update_display_img()
         self.update()
+        self.save_mask_img()
+
+    def save_mask_img(self):
+        self.stroke_engine.end_stroke()
+
+        if self.stroke_tiles is not None:
+            tiles = []
+            for (x, y), (w, h, before_data) in self.stroke_tiles.items():
+                _, _, after_data = self.undo_history.grab_tile(self.mask_img, x, y)
+                if after_data != before_data:
+                    tiles.append((x, y, w, h, before_data, after_data))
+            self.undo_history.push_tiles(self.mask_img_path, tiles)
+            self.stroke_tiles = None
 
-    def join_pixmap(self, p1, p2):
+        if self.mask_dirty:
+            self.parent().save_mask_img(self.mask_img_path, self.mask_img)
+            self.mask_dirty = False
 
-        result = QPixmap(p1.size())
-        result.fill(QtCore.Qt.transparent)
-        painter = QPainter(result)
-        painter.setRenderHint(QPainter.Antialiasing)
+    @profiled('composite')
+    def update_display_img(self, rect=None):
+        # 缓存视图大小的合成结果, 绘制时只重新合成被修改的区域
+        if not self.label_img:
+            self.display_img = None
+            return
+
+        if self.display_img is None:
+            self.display_img = QPixmap(self.label_img_size)
+            rect = None
+
+        if rect is None:
+            view_rect = self.display_img.rect()
+        else:
+            view_rect = self.mask_to_view_rect(rect).intersected(self.display_img.rect())
+            if view_rect.isEmpty():
+                return
 
+        painter = QPainter(self.display_img)
+        painter.setClipRect(view_rect)
         painter.setCompositionMode(QPainter.CompositionMode_Source)
-        painter.drawPixmap(QtCore.QPoint(), p1)
+        painter.fillRect(view_rect, QColor(190, 190, 190, 255))
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+
+        painter.setTransform(self.view_transform())
+        mask_rect = QRectF(QPointF(0, 0), QSize(self.mask_img.size()))
+        if self.view_scale < 1:
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawPixmap(mask_rect, self.label_img, QRectF(self.label_img.rect()))
+        self.draw_pyramid_tiles(painter, view_rect)
 
-        painter.setCompositionMode(QPainter.CompositionMode_Overlay)
-        painter.drawPixmap(QtCore.QPoint(), p2)
+        # 只取可见区域的mask, 通过颜色表一次完成着色和透明度, 再按透明度直接混合到原图上
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, False)
+        src_rect = self.view_transform().inverted()[0].mapRect(QRectF(view_rect)).toAlignedRect()
+        src_rect = src_rect.adjusted(-1, -1, 1, 1).intersected(self.mask_img.rect())
+        if not src_rect.isEmpty():
+            painter.drawImage(QRectF(src_rect), indexed_mask_view(self.mask_img, src_rect, self.mask_color_table))
 
         painter.end()
-        return result
+
+    def draw_pyramid_tiles(self, painter, view_rect):
+        # 放大到显示用的缩小图不够清晰时, 用原图金字塔中对应层级的分块覆盖可见区域
+        if self.pyramid is None or self.pyramid.size.isEmpty():
+            return
+
+        img_size = self.pyramid.size
+        mask_size = self.mask_img.size()
+        sx = img_size.width() / mask_size.width()
+        sy = img_size.height() / mask_size.height()
+        img_scale = self.view_scale / sx
+        if img_scale * img_size.width() <= self.label_img.width():
+            return
+
+        level = self.pyramid.choose_level(img_scale)
+        level_scale = 2 ** level
+        visible = QRectF(QPointF(view_rect.topLeft()) / self.view_scale + self.view_offset,
+                         QSize(view_rect.width(), view_rect.height()) / self.view_scale)
+        visible = QRectF(visible.x() * sx, visible.y() * sy, visible.width() * sx, visible.height() * sy)
+
+        for tx, ty in self.pyramid.visible_tiles(level, visible):
+            tile = self.pyramid.get_tile(level, tx, ty)
+            if tile is None:
+                continue
+            rect = self.pyramid.tile_rect(level, tx, ty)
+            target = QRectF(rect.x() * level_scale / sx, rect.y() * level_scale / sy,
+                            rect.width() * level_scale / sx, rect.height() * level_scale / sy)
+            painter.drawImage(target, tile, QRectF(tile.rect()))
+
+    def on_tile_ready(self):
+        self.update_display_img()
+        self.update()
+
+    def current_pen(self):
+        # mask内部是灰度图, 画笔写入255, 橡皮擦写入0
+        if self.eraser_painting_model:
+            return QPen(QColor(0, 0, 0), self.eraser_pixle_size, Qt.SolidLine, Qt.RoundCap, Qt.BevelJoin)
+        else:
+            return QPen(QColor(255, 255, 255), self.brush_pixle_size, Qt.SolidLine, Qt.RoundCap, Qt.BevelJoin)
+
+    def on_stroke_about_to_paint(self, dirty_rect):
+        # 绘制前先记下将要被修改的分块, 用于撤销
+        if self.stroke_tiles is None:
+            return
+
+        for x, y in self.undo_history.tiles_of(dirty_rect.intersected(self.mask_img.rect())):
+            if (x, y) not in self.stroke_tiles:
+                self.stroke_tiles[(x, y)] = self.undo_history.grab_tile(self.mask_img, x, y)
+
+    def on_stroke_painted(self, dirty_rect):
+        self.mask_dirty = True
+        self.update_display_img(dirty_rect)
+        self.update(self.mask_to_view_rect(dirty_rect).translated(self.img_rect.topLeft()))
 
     def mousePressEvent(self, event):
+        if event.button() in [QtCore.Qt.MiddleButton, QtCore.Qt.RightButton]:
+            self.pan_pos = event.pos()
+            self.setCursor(Qt.ClosedHandCursor)
+            return
+
+        if event.button() == QtCore.Qt.LeftButton and self.fill_model:
+            if self.label_img:
+                erase = QApplication.keyboardModifiers() == QtCore.Qt.AltModifier
+                self.parent().flood_fill(self.view_to_mask(event.pos()), erase)
+            return
+
         if event.button() == QtCore.Qt.LeftButton:
             if QApplication.keyboardModifiers() == QtCore.Qt.AltModifier:
                 self.eraser_painting_model = True
@@ -118,9 +2585,18 @@ class ImageLabel(QLabel):
 
             self.mouse_press_flag = True
             self.mouse_pos = event.pos()
-            self.update()
+            if profiler.enabled:
+                self.input_time = time.perf_counter()
+            if self.label_img:
+                self.stroke_tiles = {}
+                self.stroke_engine.begin_stroke(self.mask_img, self.current_pen(), self.view_to_mask(self.mouse_pos))
 
     def mouseMoveEvent(self, event):
+        if self.pan_pos is not None:
+            self.pan_view(event.pos() - self.pan_pos)
+            self.pan_pos = event.pos()
+            return
+
         if not self.mouse_press_flag:
             return
 
@@ -131,12 +2607,20 @@ class ImageLabel(QLabel):
             self.eraser_painting_model = False
             self.setCursor(self.brush_model_cursor)
 
+        if profiler.enabled and self.input_time is None:
+            self.input_time = time.perf_counter()
+
         self.mouse_pos = event.pos()
-        self.update()
+        self.stroke_engine.set_pen(self.current_pen())
+        self.stroke_engine.add_point(self.view_to_mask(self.mouse_pos))
 
     def mouseReleaseEvent(self, event):
-        if self.mask_img:
-            self.mask_img.save(self.mask_img_path)
+        if self.pan_pos is not None and event.button() in [QtCore.Qt.MiddleButton, QtCore.Qt.RightButton]:
+            self.pan_pos = None
+            self.set_fill_model(self.fill_model)
+            return
+
+        self.save_mask_img()
 
         if not self.mouse_press_flag:
             return
@@ -147,54 +2631,84 @@ class ImageLabel(QLabel):
 
             self.eraser_painting_model = False
             self.setCursor(self.brush_model_cursor)
-            self.parent().show_label_img()
+            self.parent().update_btn_status()
 
+    def wheelEvent(self, event):
+        # 不按修饰键时滚轮缩放视图, 按下CTRL/ALT时交给主窗口调整画笔大小
+        if QApplication.keyboardModifiers() != QtCore.Qt.NoModifier or not self.label_img:
+            event.ignore()
+            return
 
-    def paintEvent(self, QPaintEvent):
+        self.zoom_view(1.25 ** (event.angleDelta().y() / 120), event.pos())
+        event.accept()
+
+    @profiled('paint')
+    def paintEvent(self, event):
         painter = QPainter()
         painter.begin(self)
         painter.setPen(Qt.NoPen)
-        painter.fillRect(self.rect(), QColor(190, 190, 190, 255))
-
+        painter.fillRect(event.rect(), QColor(190, 190, 190, 255))
 
-        if self.label_img:
-            if self.mouse_press_flag and self.mouse_pos:
-                pp = QPainter(self.mask_img)
-                if self.eraser_painting_model:
-                    pp.setPen(QPen(self.eraser_color, self.eraser_pixle_size, Qt.SolidLine, Qt.RoundCap, Qt.BevelJoin))
-                else:
-                    pp.setPen(QPen(self.brush_color, self.brush_pixle_size, Qt.SolidLine, Qt.RoundCap, Qt.BevelJoin))
-
-                pp.drawPoint(self.mouse_pos - self.img_rect.topLeft())
-
-            result_pixmap = self.join_pixmap(self.label_img, self.mask_img)
-            painter.drawPixmap(self.img_rect, result_pixmap)
+        if self.display_img:
+            target_rect = event.rect().intersected(self.img_rect)
+            if not target_rect.isEmpty():
+                painter.drawPixmap(target_rect, self.display_img, target_rect.translated(-self.img_rect.topLeft()))
 
         painter.end()
 
+        # 从收到鼠标事件到绘制到屏幕上的延迟
+        if self.input_time is not None:
+            profiler.record('input_to_pixel', self.input_time, time.perf_counter())
+            self.input_time = None
+
     def resizeEvent(self, event):
         x = (self.size().width() - self.label_img_size.width()) // 2
         y = (self.size().height() - self.label_img_size.height()) // 2
         self.img_rect = QRect(QPoint(x,y), QPoint(self.label_img_size.width()+x, self.label_img_size.height()+y))
 
 class MainWindow(QWidget):
-    def __init__(self, parent=None):
+    nav_loaded = QtCore.Signal(int)
+    mask_index_updated = QtCore.Signal()
+
+    def __init__(self, parent=None, mask_format='bmp', mask_img_size=QSize(512,512), cache_mb=512, prefetch_count=3):
         QWidget.__init__(self, parent)
 
         self.setWindowTitle('MASK标注工具')
-        self.setFixedSize(1000, 650)
+        self.setFixedSize(1000, 780)
         self.move_to_center()
 
         #
-        self.mask_img_size = QSize(512,512)
+        self.label_img_size = QSize(512,512)
+        self.mask_img_size = mask_img_size  # None表示按原图大小标注
+        self.mask_format = mask_format
         self.brush_color = QColor(255,255,0)
         self.eraser_color = QColor(0,0,0)
-        self.label_img = ImageLabel(self,self.mask_img_size, self.brush_color, self.eraser_color)
+        self.label_img = ImageLabel(self,self.label_img_size, self.brush_color, self.eraser_color)
         self.label_img.setAlignment(Qt.AlignCenter)
         self.label_img.setText('没有选择任何图片')
         self.label_img.setFixedWidth(700)
         self.label_img.setFixedHeight(600)
 
+        self.thumb_size = 96
+        self.thumb_cache = None
+        self.thumb_pool = QtCore.QThreadPool(self)
+        self.thumb_pool.setMaxThreadCount(max(1, min(4, QtCore.QThread.idealThreadCount() - 1)))
+        self.thumb_model = ThumbnailModel(self.thumb_pool, parent=self)
+        self.filmstrip = QListView(self)
+        self.filmstrip.setModel(self.thumb_model)
+        self.filmstrip.setFlow(QListView.LeftToRight)
+        self.filmstrip.setWrapping(False)
+        self.filmstrip.setMovement(QListView.Static)
+        self.filmstrip.setUniformItemSizes(True)
+        self.filmstrip.setLayoutMode(QListView.Batched)
+        self.filmstrip.setIconSize(QSize(self.thumb_size, self.thumb_size))
+        self.filmstrip.setGridSize(QSize(self.thumb_size + 8, self.thumb_size + 8))
+        self.filmstrip.setFixedWidth(700)
+        self.filmstrip.setFixedHeight(self.thumb_size + 30)
+        self.filmstrip.setFocusPolicy(Qt.NoFocus)
+        self.filmstrip.clicked.connect(self.on_filmstrip_clicked)
+        self.filmstrip.horizontalScrollBar().valueChanged.connect(self.thumb_model.clear_pending)
+
         #
         self.btn_select_dir = QPushButton(self)
         self.btn_select_dir.setText('选择目录...')
@@ -244,40 +2758,169 @@ class MainWindow(QWidget):
 
         self.label_img.update_brush_pixle_size(self.defalut_brush_pixle_size)
 
-        self.defalut_eraser_pixle_size = 50
-        self.min_eraser_pixle_size = 5
-        self.max_eraser_pixle_size = 50
-        self.label_eraser_pixle_size = QLabel('橡皮擦像素大小:')
-        self.label_eraser_pixle_size.setFixedWidth(110)
-        self.edit_eraser_pixle_size_validator = QIntValidator()
-        self.edit_eraser_pixle_size_validator.setRange(self.min_eraser_pixle_size, self.max_eraser_pixle_size)
-        self.edit_eraser_pixle_size = QLineEdit(self)
-        self.edit_eraser_pixle_size.setText(f'{self.defalut_eraser_pixle_size}')
-        self.edit_eraser_pixle_size.setValidator(self.edit_eraser_pixle_size_validator)
-        self.edit_eraser_pixle_size.textChanged.connect(self.on_edit_eraser_pixle_size_change)
+        self.defalut_eraser_pixle_size = 50
+        self.min_eraser_pixle_size = 5
+        self.max_eraser_pixle_size = 50
+        self.label_eraser_pixle_size = QLabel('橡皮擦像素大小:')
+        self.label_eraser_pixle_size.setFixedWidth(110)
+        self.edit_eraser_pixle_size_validator = QIntValidator()
+        self.edit_eraser_pixle_size_validator.setRange(self.min_eraser_pixle_size, self.max_eraser_pixle_size)
+        self.edit_eraser_pixle_size = QLineEdit(self)
+        self.edit_eraser_pixle_size.setText(f'{self.defalut_eraser_pixle_size}')
+        self.edit_eraser_pixle_size.setValidator(self.edit_eraser_pixle_size_validator)
+        self.edit_eraser_pixle_size.textChanged.connect(self.on_edit_eraser_pixle_size_change)
+
+        self.label_img.update_eraser_pixle_size(self.defalut_eraser_pixle_size)
+
+        self.defalut_mask_opacity = 50
+        self.label_mask_opacity = QLabel('标注不透明度(%):')
+        self.label_mask_opacity.setFixedWidth(110)
+        self.edit_mask_opacity_validator = QIntValidator()
+        self.edit_mask_opacity_validator.setRange(0, 100)
+        self.edit_mask_opacity = QLineEdit(self)
+        self.edit_mask_opacity.setText(f'{self.defalut_mask_opacity}')
+        self.edit_mask_opacity.setValidator(self.edit_mask_opacity_validator)
+        self.edit_mask_opacity.textChanged.connect(self.on_edit_mask_opacity_change)
+
+        self.btn_clear_mask = QPushButton(self)
+        self.btn_clear_mask.setText('全部擦除')
+        self.btn_clear_mask.clicked.connect(self.on_btn_clear_mask)
+
+        self.btn_roate = QPushButton(self)
+        self.btn_roate.setText('旋转')
+        self.btn_roate.clicked.connect(self.on_btn_roate)
+
+        self.btn_roate_img = QPushButton(self)
+        self.btn_roate_img.setText('旋转原图')
+        self.btn_roate_img.clicked.connect(self.on_btn_roate_img)
+        self.connect(
+            QShortcut(QKeySequence(Qt.Key_Up), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_roate_img.click
+        )
+
+        self.btn_roate_mask = QPushButton(self)
+        self.btn_roate_mask.setText('旋转标注图')
+        self.btn_roate_mask.clicked.connect(self.on_btn_roate_mask)
+
+        self.btn_next_unannotated_img = QPushButton(self)
+        self.btn_next_unannotated_img.setText('下一张未标注')
+        self.btn_next_unannotated_img.clicked.connect(self.on_btn_next_unannotated_img)
+        self.connect(
+            QShortcut(QKeySequence('Ctrl+Right'), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_next_unannotated_img.click
+        )
+
+        self.btn_undo = QPushButton(self)
+        self.btn_undo.setText('撤销')
+        self.btn_undo.clicked.connect(self.on_btn_undo)
+        self.connect(
+            QShortcut(QKeySequence('Ctrl+Z'), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_undo.click
+        )
+
+        self.btn_redo = QPushButton(self)
+        self.btn_redo.setText('重做')
+        self.btn_redo.clicked.connect(self.on_btn_redo)
+        self.connect(
+            QShortcut(QKeySequence('Ctrl+Y'), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_redo.click
+        )
+
+        self.btn_batch_roate = QPushButton(self)
+        self.btn_batch_roate.setText('批量旋转...')
+        self.btn_batch_roate.clicked.connect(self.on_btn_batch_roate)
+
+        self.defalut_morph_pixle_size = 2
+        self.label_morph_pixle_size = QLabel('膨胀腐蚀像素:')
+        self.label_morph_pixle_size.setFixedWidth(110)
+        self.edit_morph_pixle_size_validator = QIntValidator()
+        self.edit_morph_pixle_size_validator.setRange(1, 50)
+        self.edit_morph_pixle_size = QLineEdit(self)
+        self.edit_morph_pixle_size.setText(f'{self.defalut_morph_pixle_size}')
+        self.edit_morph_pixle_size.setValidator(self.edit_morph_pixle_size_validator)
+
+        self.btn_dilate_mask = QPushButton(self)
+        self.btn_dilate_mask.setText('膨胀')
+        self.btn_dilate_mask.clicked.connect(self.on_btn_dilate_mask)
+        self.connect(
+            QShortcut(QKeySequence(Qt.Key_D), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_dilate_mask.click
+        )
+
+        self.btn_erode_mask = QPushButton(self)
+        self.btn_erode_mask.setText('腐蚀')
+        self.btn_erode_mask.clicked.connect(self.on_btn_erode_mask)
+        self.connect(
+            QShortcut(QKeySequence(Qt.Key_E), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_erode_mask.click
+        )
+
+        self.btn_fill_mask_holes = QPushButton(self)
+        self.btn_fill_mask_holes.setText('填充空洞')
+        self.btn_fill_mask_holes.clicked.connect(self.on_btn_fill_mask_holes)
+        self.connect(
+            QShortcut(QKeySequence(Qt.Key_H), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_fill_mask_holes.click
+        )
 
-        self.label_img.update_eraser_pixle_size(self.defalut_eraser_pixle_size)
+        self.min_component_area = 50
+        self.btn_remove_small_components = QPushButton(self)
+        self.btn_remove_small_components.setText('去除小区域...')
+        self.btn_remove_small_components.clicked.connect(self.on_btn_remove_small_components)
+        self.connect(
+            QShortcut(QKeySequence(Qt.Key_R), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_remove_small_components.click
+        )
 
-        self.btn_clear_mask = QPushButton(self)
-        self.btn_clear_mask.setText('全部擦除')
-        self.btn_clear_mask.clicked.connect(self.on_btn_clear_mask)
+        self.btn_invert_mask = QPushButton(self)
+        self.btn_invert_mask.setText('反选')
+        self.btn_invert_mask.clicked.connect(self.on_btn_invert_mask)
+        self.connect(
+            QShortcut(QKeySequence(Qt.Key_I), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_invert_mask.click
+        )
 
-        self.btn_roate = QPushButton(self)
-        self.btn_roate.setText('旋转')
-        self.btn_roate.clicked.connect(self.on_btn_roate)
+        self.btn_threshold_mask = QPushButton(self)
+        self.btn_threshold_mask.setText('阈值分割...')
+        self.btn_threshold_mask.clicked.connect(self.on_btn_threshold_mask)
+        self.connect(
+            QShortcut(QKeySequence(Qt.Key_T), self),
+            QtCore.SIGNAL('activated()'),
+            self.btn_threshold_mask.click
+        )
 
-        self.btn_roate_img = QPushButton(self)
-        self.btn_roate_img.setText('旋转原图')
-        self.btn_roate_img.clicked.connect(self.on_btn_roate_img)
+        self.btn_fill_model = QPushButton(self)
+        self.btn_fill_model.setText('填充工具')
+        self.btn_fill_model.setCheckable(True)
+        self.btn_fill_model.toggled.connect(self.label_img.set_fill_model)
         self.connect(
-            QShortcut(QKeySequence(Qt.Key_Up), self),
+            QShortcut(QKeySequence(Qt.Key_F), self),
             QtCore.SIGNAL('activated()'),
-            self.btn_roate_img.click
+            self.btn_fill_model.toggle
         )
 
-        self.btn_roate_mask = QPushButton(self)
-        self.btn_roate_mask.setText('旋转标注图')
-        self.btn_roate_mask.clicked.connect(self.on_btn_roate_mask)
+        self.label_fill_tolerance = QLabel('魔棒容差:')
+        self.edit_fill_tolerance_validator = QIntValidator()
+        self.edit_fill_tolerance_validator.setRange(0, 255)
+        self.edit_fill_tolerance = QLineEdit(self)
+        self.edit_fill_tolerance.setText('0')
+        self.edit_fill_tolerance.setToolTip('0表示按已有标注的边界填充, 大于0表示按原图颜色相近的区域填充')
+        self.edit_fill_tolerance.setValidator(self.edit_fill_tolerance_validator)
+
+        self.connect(
+            QShortcut(QKeySequence('Ctrl+0'), self),
+            QtCore.SIGNAL('activated()'),
+            self.label_img.fit_view
+        )
 
         self.label_lable_docs = QLabel(self)
         self.label_lable_docs.setAlignment(Qt.AlignLeft)
@@ -287,9 +2930,16 @@ class MainWindow(QWidget):
 
 - CTRL+鼠标滚轮,调整画笔像素大小
 - ALT+鼠标滚轮,调整橡皮擦像素大小
+- 鼠标滚轮缩放图片, 鼠标中键或右键拖动平移
+- CTRL+0恢复到适应窗口大小
 
 - 键盘左方向键切换到上一张图片
 - 键盘右方向键切换到下一张图片
+- CTRL+右方向键切换到下一张未标注的图片
+
+- CTRL+Z撤销, CTRL+Y重做
+- D膨胀, E腐蚀, H填充空洞, R去除小区域, I反选, T阈值分割
+- F切换填充工具, 单击填充, ALT+单击擦除, 容差为0时按标注边界填充
 
 - 输入张数加回车跳转到指定张数
         ''')
@@ -310,6 +2960,16 @@ class MainWindow(QWidget):
         self.label_status_running2.setText('张')
         self.label_status_running2.hide()
 
+        # 启用性能统计时在状态栏显示最近的耗时 p50/p95/p99
+        self.label_status_profile = QLabel(self)
+        self.label_status_profile.setAlignment(Qt.AlignRight)
+        self.label_status_profile.setVisible(profiler.enabled)
+        self.profile_timer = QtCore.QTimer(self)
+        self.profile_timer.setInterval(500)
+        self.profile_timer.timeout.connect(self.on_profile_timer)
+        if profiler.enabled:
+            self.profile_timer.start()
+
 
         # 布局
         layout_root = QVBoxLayout()
@@ -327,8 +2987,10 @@ class MainWindow(QWidget):
         layout_root_row2.addWidget(self.label_status_running1)
         layout_root_row2.addWidget(self.label_status_page_number)
         layout_root_row2.addWidget(self.label_status_running2)
+        layout_root_row2.addWidget(self.label_status_profile)
 
         layout_col1.addWidget(self.label_img)
+        layout_col1.addWidget(self.filmstrip)
 
 
         layout_col2_row1 = QHBoxLayout()
@@ -338,6 +3000,9 @@ class MainWindow(QWidget):
         layout_col2_row2.addWidget(self.btn_prev_img)
         layout_col2_row2.addWidget(self.btn_next_img)
 
+        layout_col2_row2_1 = QHBoxLayout()
+        layout_col2_row2_1.addWidget(self.btn_next_unannotated_img)
+
         layout_col2_row3 = QHBoxLayout()
         layout_col2_row3.addWidget(self.label_brush_pixle_size)
         layout_col2_row3.addWidget(self.edit_brush_pixle_size)
@@ -350,15 +3015,51 @@ class MainWindow(QWidget):
         layout_col2_row5.addWidget(self.btn_select_brush_color)
         layout_col2_row5.addWidget(self.label_brush_color)
 
+        layout_col2_row5_1 = QHBoxLayout()
+        layout_col2_row5_1.addWidget(self.label_mask_opacity)
+        layout_col2_row5_1.addWidget(self.edit_mask_opacity)
+
         layout_col2.addLayout(layout_col2_row1)
         layout_col2.addLayout(layout_col2_row2)
+        layout_col2.addLayout(layout_col2_row2_1)
         layout_col2.addLayout(layout_col2_row5)
+        layout_col2.addLayout(layout_col2_row5_1)
         layout_col2.addLayout(layout_col2_row3)
         layout_col2.addLayout(layout_col2_row4)
+        layout_col2_row6 = QHBoxLayout()
+        layout_col2_row6.addWidget(self.btn_undo)
+        layout_col2_row6.addWidget(self.btn_redo)
+
+        layout_col2.addLayout(layout_col2_row6)
+
+        layout_col2_row7 = QHBoxLayout()
+        layout_col2_row7.addWidget(self.label_morph_pixle_size)
+        layout_col2_row7.addWidget(self.edit_morph_pixle_size)
+
+        layout_col2_row8 = QHBoxLayout()
+        layout_col2_row8.addWidget(self.btn_dilate_mask)
+        layout_col2_row8.addWidget(self.btn_erode_mask)
+        layout_col2_row8.addWidget(self.btn_fill_mask_holes)
+
+        layout_col2_row9 = QHBoxLayout()
+        layout_col2_row9.addWidget(self.btn_remove_small_components)
+        layout_col2_row9.addWidget(self.btn_invert_mask)
+        layout_col2_row9.addWidget(self.btn_threshold_mask)
+
+        layout_col2.addLayout(layout_col2_row7)
+        layout_col2.addLayout(layout_col2_row8)
+        layout_col2_row10 = QHBoxLayout()
+        layout_col2_row10.addWidget(self.btn_fill_model)
+        layout_col2_row10.addWidget(self.label_fill_tolerance)
+        layout_col2_row10.addWidget(self.edit_fill_tolerance)
+
+        layout_col2.addLayout(layout_col2_row9)
+        layout_col2.addLayout(layout_col2_row10)
         layout_col2.addWidget(self.btn_clear_mask)
         layout_col2.addWidget(self.btn_roate)
         layout_col2.addWidget(self.btn_roate_img)
         layout_col2.addWidget(self.btn_roate_mask)
+        layout_col2.addWidget(self.btn_batch_roate)
         layout_col2.addWidget(self.label_lable_docs)
         layout_col2.addStretch()
 
@@ -368,64 +3069,450 @@ class MainWindow(QWidget):
         self.directory = None
         self.all_img_file = []
         self.all_img_file_index = 0
+        self.current_img_path = None
+        self.dir_scanner = None
+        self.dir_rescan = False
+        self.dir_scan_navigated = False
+        self.dir_watcher = DirWatcher(self)
+        self.dir_watcher.changed.connect(self.on_dir_changed)
+        self.batch_rotate_thread = None
+        self.mask_index = None
+        self.mask_index_pool = QtCore.QThreadPool(self)
+        self.mask_index_pool.setMaxThreadCount(1)
+
+        self.img_cache_max_bytes = cache_mb * 1024 * 1024
+        self.prefetch_count = prefetch_count
+        self.img_cache = ImageCache(self.img_cache_max_bytes)
+        self.prefetch_pool = QtCore.QThreadPool(self)
+        self.prefetch_pool.setMaxThreadCount(max(1, min(4, QtCore.QThread.idealThreadCount() - 1)))
+        self.tile_pool = QtCore.QThreadPool(self)
+        self.tile_pool.setMaxThreadCount(max(1, min(4, QtCore.QThread.idealThreadCount() - 1)))
+        self.nav_pool = QtCore.QThreadPool(self)
+        self.nav_pool.setMaxThreadCount(1)
+        self.nav_generation = 0
+        self.nav_loaded.connect(self.on_nav_loaded)
+        self.mask_index_updated.connect(self.update_btn_status)
+
+        self.mask_saver = MaskSaver(self)
+        self.mask_saver.saved.connect(self.on_mask_saved)
+        self.mask_saver.failed.connect(self.on_mask_save_failed)
+        self.mask_saver.start()
 
         self.update_btn_status()
 
 
+    def closeEvent(self, event):
+        if self.dir_scanner is not None:
+            self.dir_scanner.cancel()
+            self.dir_scanner.wait()
+        self.dir_watcher.stop()
+        self.dir_watcher.wait()
+        if self.batch_rotate_thread is not None:
+            self.batch_rotate_thread.wait()
+        self.label_img.save_mask_img()
+        self.prefetch_pool.clear()
+        self.prefetch_pool.waitForDone()
+        self.tile_pool.clear()
+        self.tile_pool.waitForDone()
+        self.nav_pool.clear()
+        self.nav_pool.waitForDone()
+        self.mask_saver.stop()
+        self.close_mask_index()
+        self.close_thumb_cache()
+        if profiler.enabled and profiler.trace_path:
+            try:
+                profiler.export_chrome_trace(profiler.trace_path)
+            except:
+                logging.exception(f'export trace {profiler.trace_path} exception')
+        event.accept()
+
+    def on_profile_timer(self):
+        self.label_status_profile.setText(profiler.summary(['input_to_pixel', 'paint', 'composite', 'navigate', 'decode']))
+
+    def save_mask_img(self, mask_img_path, mask_img):
+        self.img_cache.discard(mask_img_path)
+        # 保存线程延迟写入, 传一份拷贝, 之后的绘制和撤销不会改到还没写完的mask
+        self.mask_saver.save(mask_img_path, mask_img.copy(), self.mask_format, self.brush_color)
+
+    def prefetch_neighbors(self):
+        self.prefetch_pool.clear()
+
+        neighbors = []
+        for i in range(1, self.prefetch_count + 1):
+            for index in [self.all_img_file_index + i, self.all_img_file_index - i]:
+                if 0 <= index < len(self.all_img_file):
+                    neighbors.append(self.all_img_file[index])
+
+        neighbor_masks = [find_mask_img_path(x, self.mask_format) for x in neighbors]
+        self.img_cache.set_wanted(neighbors + neighbor_masks)
+        for img_path, mask_img_path in zip(neighbors, neighbor_masks):
+            self.prefetch_pool.start(ImageLoadTask(self.img_cache, 'img', img_path, self.label_img_size))
+            self.prefetch_pool.start(ImageLoadTask(self.img_cache, 'mask', mask_img_path))
+
+    def on_mask_saved(self, mask_img_path, mask_img):
+        if self.mask_index and Path(mask_img_path).parent.parent == self.mask_index.directory:
+            # 和目录同步任务在同一个单线程池里, 按提交顺序执行
+            self.mask_index_pool.start(MaskIndexUpdateTask(self.mask_index, mask_img_path, mask_img, self.mask_index_updated.emit))
+        self.thumb_model.invalidate_stem(Path(mask_img_path).stem)
+
+    def open_thumb_cache(self, directory):
+        self.close_thumb_cache()
+        try:
+            self.thumb_cache = ThumbnailCache(directory, self.mask_format, self.thumb_size)
+            self.thumb_cache.overlay_color = self.brush_color
+            self.thumb_cache.overlay_opacity = self.label_img.mask_opacity
+        except (sqlite3.Error, OSError):
+            logging.exception(f'open thumbnail cache {directory} exception')
+        self.thumb_model.set_cache(self.thumb_cache)
+
+    def close_thumb_cache(self):
+        self.thumb_model.set_cache(None)
+        self.thumb_pool.waitForDone()
+        if self.thumb_cache:
+            self.thumb_cache.close()
+            self.thumb_cache = None
+
+    def select_filmstrip_item(self):
+        if 0 <= self.all_img_file_index < self.thumb_model.rowCount():
+            index = self.thumb_model.index(self.all_img_file_index)
+            self.filmstrip.setCurrentIndex(index)
+            self.filmstrip.scrollTo(index, QListView.PositionAtCenter)
+
+    def on_filmstrip_clicked(self, index):
+        try:
+            if index.row() != self.all_img_file_index:
+                self.all_img_file_index = index.row()
+                self.request_label_img()
+        finally:
+            self.update_btn_status()
+
+    def open_mask_index(self, directory):
+        self.close_mask_index()
+        try:
+            self.mask_index = MaskIndex(directory, self.mask_format)
+        except (sqlite3.Error, OSError):
+            logging.exception(f'open mask index {directory} exception')
+
+    def close_mask_index(self):
+        if self.mask_index:
+            self.mask_index.canceled = True
+            self.mask_index_pool.clear()
+            self.mask_index_pool.waitForDone()
+            self.mask_index.close()
+            self.mask_index = None
+
+    def on_mask_save_failed(self, mask_img_path, error):
+        QMessageBox.warning(
+            self,
+            '<错误>',
+            f'标注文件<{mask_img_path}>保存失败: {error}',
+            QMessageBox.Ok
+        )
+
     def move_to_center(self):
         screen = QDesktopWidget().screenGeometry()
         size = self.geometry()
         self.move((screen.width() - size.width()) / 2, (screen.height() - size.height()) / 2)
 
     def on_btn_select_dir(self):
+        if self.dir_scanner is not None:
+            self.dir_scanner.cancel()
+            return
+
+        directory = QFileDialog.getExistingDirectory(self, '选择图片目录')
+        if not directory:
+            return
+
+        self.open_dir(directory)
+
+    def open_dir(self, directory):
+        # 重新扫描当前目录时保留原来的列表, 扫描完成后整体替换, 取消扫描时保持不变
+        self.dir_rescan = bool(self.all_img_file) and directory == self.directory
+        self.dir_scan_navigated = False
+        self.dir_scanner = DirScanner(directory, self)
+        self.dir_scanner.found.connect(self.on_dir_scan_found)
+        self.dir_scanner.done.connect(self.on_dir_scan_done)
+        self.dir_scanner.start()
+
+        self.btn_select_dir.setText('取消扫描')
+        self.update_btn_status()
+
+    def on_dir_scan_found(self, img_files):
         try:
-            self.directory = QFileDialog.getExistingDirectory(self, '选择图片目录')
+            if self.dir_rescan:
+                return
+
+            if self.directory != self.dir_scanner.directory:
+                self.label_img.save_mask_img()
+                self.dir_watcher.stop()
+                self.directory = self.dir_scanner.directory
+                self.setWindowTitle(f'MASK标注工具: {self.directory}')
+                self.img_cache.clear()
+                self.label_img.undo_history.clear()
+                self.open_mask_index(self.directory)
+                self.open_thumb_cache(self.directory)
+                self.all_img_file = []
+                self.all_img_file_index = 0
+                self.current_img_path = None
 
-            all_img_file = sorted([x for x in Path(self.directory).iterdir(
-            ) if x.is_file() and x.suffix.upper() in ['.JPG', '.JPEG', '.BMP', '.PNG']])
+            self.all_img_file.extend(img_files)
+            self.thumb_model.set_img_files(self.all_img_file)
+            if self.current_img_path is None:
+                self.show_label_img()
+        finally:
+            self.update_btn_status()
+
+    def on_dir_scan_done(self, all_img_file, canceled):
+        try:
+            directory = self.dir_scanner.directory
+            self.dir_scanner.wait()
+            self.dir_scanner = None
+            self.btn_select_dir.setText('选择目录...')
 
             if len(all_img_file) <= 0:
-                QMessageBox.information(
-                    self,
-                    '<提示>',
-                    f'{self.directory}\n目录下没有找到图片文件',
-                    QMessageBox.Ok
-                )
+                if not canceled:
+                    QMessageBox.information(
+                        self,
+                        '<提示>',
+                        f'{directory}\n目录下没有找到图片文件',
+                        QMessageBox.Ok
+                    )
+                return
+
+            if self.directory != directory:
+                return
+
+            if canceled and self.dir_rescan:
+                # 扫描过程中目录的变化没有合并进来, 重新比较一次
+                self.dir_watcher.watch(self.directory, self.all_img_file)
+                self.dir_watcher.list_files()
                 return
 
-            self.setWindowTitle(f'MASK标注工具: {self.directory}')
+            if self.dir_rescan or self.dir_scan_navigated:
+                # 扫描过程中列表是按发现顺序排列的, 排序后重新定位到当前图片
+                current_img_path = self.all_img_file[self.all_img_file_index]
+            else:
+                # 扫描过程中没有翻页, 显示的只是最先找到的图片, 排序后回到第一张
+                current_img_path = all_img_file[0]
             self.all_img_file = all_img_file
-            self.all_img_file_index = 0
-            self.show_label_img()
+            index = bisect.bisect_left(all_img_file, current_img_path)
+            self.all_img_file_index = min(index, len(all_img_file) - 1)
+            self.thumb_model.set_img_files(self.all_img_file)
+            self.dir_watcher.watch(self.directory, self.all_img_file)
+            if index >= len(all_img_file) or all_img_file[index] != current_img_path:
+                # 当前图片已经不在目录里了
+                self.show_label_img()
+            elif current_img_path != self.current_img_path:
+                self.request_label_img()
+            else:
+                self.select_filmstrip_item()
+                self.prefetch_neighbors()
+
+            if self.mask_index:
+                self.mask_index_pool.start(MaskIndexSyncTask(self.mask_index, self.all_img_file))
+        finally:
+            self.update_btn_status()
+
+    def on_dir_changed(self, added, removed):
+        # 目录里新增或删除了图片, 合并到排好序的列表里, 保持当前图片不变
+        try:
+            if self.dir_scanner is not None or self.directory is None:
+                return
+
+            current_img_path = self.all_img_file[self.all_img_file_index] if self.all_img_file else None
+            for img_path in removed:
+                self.img_cache.discard(img_path)
+
+            if len(added) + len(removed) > 1000:
+                # 大批量变化时整体合并, 重置缩略图列表
+                all_img_file = [x for x in self.all_img_file if x not in removed] if removed else self.all_img_file
+                self.all_img_file = list(heapq.merge(all_img_file, added))
+                self.thumb_model.set_img_files(self.all_img_file)
+            else:
+                # 少量变化时二分查找逐个增删, 不遍历整个列表
+                for img_path in removed:
+                    row = bisect.bisect_left(self.all_img_file, img_path)
+                    if row < len(self.all_img_file) and self.all_img_file[row] == img_path:
+                        del self.all_img_file[row]
+                        self.thumb_model.remove_img_file(row)
+                for img_path in added:
+                    row = bisect.bisect_left(self.all_img_file, img_path)
+                    self.all_img_file.insert(row, img_path)
+                    self.thumb_model.insert_img_file(row, img_path)
+
+            all_img_file = self.all_img_file
+            if current_img_path is None:
+                self.all_img_file_index = 0
+            else:
+                self.all_img_file_index = max(0, min(bisect.bisect_left(all_img_file, current_img_path), len(all_img_file) - 1))
+
+            if self.mask_index:
+                self.mask_index_pool.start(MaskIndexSyncTask(self.mask_index, added, [x.name for x in removed]))
+
+            if not self.all_img_file:
+                return
+            if current_img_path is None or current_img_path in removed:
+                # 当前图片被删除了, 显示排在它后面的图片
+                self.show_label_img()
+            else:
+                self.select_filmstrip_item()
+                self.prefetch_neighbors()
         finally:
             self.update_btn_status()
 
     def on_btn_next_img(self):
         try:
             self.all_img_file_index += 1
-            self.show_label_img()
+            self.request_label_img()
+        finally:
+            self.update_btn_status()
+
+    def on_btn_next_unannotated_img(self):
+        try:
+            if not self.mask_index:
+                return
+
+            for index in range(self.all_img_file_index + 1, len(self.all_img_file)):
+                if not self.mask_index.is_annotated(self.all_img_file[index]):
+                    self.all_img_file_index = index
+                    self.request_label_img()
+                    return
+
+            QMessageBox.information(
+                self,
+                '<提示>',
+                '后面没有未标注的图片了',
+                QMessageBox.Ok
+            )
         finally:
             self.update_btn_status()
 
     def on_btn_prev_img(self):
         try:
             self.all_img_file_index -= 1
-            self.show_label_img()
+            self.request_label_img()
         finally:
             self.update_btn_status()
 
     def on_btn_select_brush_color(self):
-        self.brush_color = QColorDialog.getColor()
+        color = QColorDialog.getColor(self.brush_color, self)
+        if not color.isValid():
+            # 取消了颜色对话框
+            return
+        self.brush_color = color
         self.label_img.update_brush_color(self.brush_color)
+        if self.thumb_cache:
+            self.thumb_cache.overlay_color = self.brush_color
+            self.thumb_model.refresh()
 
         pe = QPalette()
         pe.setColor(QPalette.Window, self.brush_color)
         self.label_brush_color.setPalette(pe)
         self.label_brush_color.setAutoFillBackground(True)
 
+    def on_btn_undo(self):
+        try:
+            self.label_img.undo()
+        finally:
+            self.update_btn_status()
+
+    def on_btn_redo(self):
+        try:
+            self.label_img.redo()
+        finally:
+            self.update_btn_status()
+
     def on_btn_clear_mask(self):
         self.show_label_img(do_clear=True)
 
+    def mask_op_buttons(self):
+        return [
+            self.btn_dilate_mask,
+            self.btn_erode_mask,
+            self.btn_fill_mask_holes,
+            self.btn_remove_small_components,
+            self.btn_invert_mask,
+            self.btn_threshold_mask,
+            self.btn_fill_model,
+        ]
+
+    def morph_pixle_size(self):
+        if self.edit_morph_pixle_size.text():
+            return int(self.edit_morph_pixle_size.text())
+        return self.defalut_morph_pixle_size
+
+    def apply_mask_op(self, op):
+        try:
+            self.label_img.apply_mask_op(op)
+        except Exception as e:
+            logging.exception('apply mask op exception')
+            QMessageBox.warning(self, '<错误>', f'mask处理失败: {e}', QMessageBox.Ok)
+        finally:
+            self.update_btn_status()
+
+    def on_btn_dilate_mask(self):
+        n = self.morph_pixle_size()
+        self.apply_mask_op(lambda fg: dilate_mask(fg, n))
+
+    def on_btn_erode_mask(self):
+        n = self.morph_pixle_size()
+        self.apply_mask_op(lambda fg: erode_mask(fg, n))
+
+    def on_btn_fill_mask_holes(self):
+        self.apply_mask_op(fill_mask_holes)
+
+    def on_btn_remove_small_components(self):
+        min_area, ok = QInputDialog.getInt(self, '去除小区域', '最小面积(像素):', self.min_component_area, 1, 1000000)
+        if not ok:
+            return
+        self.min_component_area = min_area
+        self.apply_mask_op(lambda fg: remove_small_components(fg, min_area))
+
+    def on_btn_invert_mask(self):
+        self.apply_mask_op(lambda fg: ~fg)
+
+    def flood_fill(self, point, erase=False):
+        mask_size = self.label_img.mask_img.size()
+        x = int(point.x())
+        y = int(point.y())
+        if not (0 <= x < mask_size.width() and 0 <= y < mask_size.height()):
+            return
+
+        tolerance = int(self.edit_fill_tolerance.text()) if self.edit_fill_tolerance.text() else 0
+        rgb = None
+        if tolerance > 0:
+            # 翻页加载过程中all_img_file_index已经指向下一张, 这里要用正在显示的图片
+            img_path = self.current_img_path
+            img = self.img_cache.load('img', img_path, mask_size)
+            if img is None or img.isNull():
+                QMessageBox.warning(self, '<错误>', f'读取图片<{img_path}>失败', QMessageBox.Ok)
+                return
+            rgb = image_to_rgb_array(img)
+
+        def op(fg):
+            if rgb is None:
+                # 按标注边界填充: 和点击位置标注状态相同的连通区域
+                region = fg if fg[y, x] else ~fg
+            else:
+                region = color_similar_region(rgb, x, y, tolerance)
+            filled = flood_fill_region(region, x, y)
+            return fg & ~filled if erase else fg | filled
+
+        self.apply_mask_op(op)
+
+    def on_btn_threshold_mask(self):
+        img_path = self.current_img_path
+        img = self.img_cache.load('img', img_path, self.label_img.mask_img.size())
+        if img is None or img.isNull():
+            QMessageBox.warning(self, '<错误>', f'读取图片<{img_path}>失败', QMessageBox.Ok)
+            return
+
+        gray = image_to_gray_array(img)
+        threshold, ok = QInputDialog.getInt(self, '阈值分割', '灰度大于等于阈值的区域作为标注(默认为自动阈值):', otsu_threshold(gray), 0, 255)
+        if not ok:
+            return
+        self.apply_mask_op(lambda fg: threshold_mask(gray, threshold))
+
     def on_btn_roate(self):
         self.show_label_img(do_roate=True)
 
@@ -435,12 +3522,56 @@ class MainWindow(QWidget):
     def on_btn_roate_mask(self):
         self.show_label_img(do_roate_mask=True)
 
+    def on_btn_batch_roate(self):
+        start, ok = QInputDialog.getInt(self, '批量旋转', '从第几张开始:', self.all_img_file_index + 1, 1, len(self.all_img_file))
+        if not ok:
+            return
+        end, ok = QInputDialog.getInt(self, '批量旋转', '到第几张结束:', len(self.all_img_file), start, len(self.all_img_file))
+        if not ok:
+            return
+
+        self.label_img.save_mask_img()
+        self.mask_saver.flush(wait=True)
+
+        self.batch_rotate_thread = BatchRotateThread(self.all_img_file[start - 1:end], self.mask_format, parent=self)
+        self.batch_rotate_thread.progress.connect(self.on_batch_rotate_progress)
+        self.batch_rotate_thread.done.connect(self.on_batch_rotate_done)
+        self.batch_rotate_thread.start()
+        self.update_btn_status()
+
+    def on_batch_rotate_progress(self, done, total):
+        self.label_status_running1.setText(f'正在批量旋转: {done}/{total}')
+
+    def on_batch_rotate_done(self, errors):
+        try:
+            img_files = self.batch_rotate_thread.img_files
+            self.batch_rotate_thread.wait()
+            self.batch_rotate_thread = None
+
+            self.img_cache.clear()
+            for img_path in img_files:
+                self.label_img.undo_history.clear(str(get_mask_img_path(img_path, self.mask_format)))
+                self.thumb_model.invalidate_stem(img_path.stem)
+            self.show_label_img()
+            if self.mask_index:
+                self.mask_index_pool.start(MaskIndexSyncTask(self.mask_index, img_files))
+
+            if errors:
+                QMessageBox.warning(
+                    self,
+                    '<错误>',
+                    f'{len(errors)}张图片旋转失败:\n' + '\n'.join(errors[:10]),
+                    QMessageBox.Ok
+                )
+        finally:
+            self.update_btn_status()
+
     def on_page_jump(self):
         try:
             page_num = int(self.label_status_page_number.text())
             if page_num >= 1 and page_num <= len(self.all_img_file):
                 self.all_img_file_index = page_num - 1
-            self.show_label_img()
+            self.request_label_img()
             self.setFocus()
         finally:
             self.update_btn_status()
@@ -472,6 +3603,13 @@ class MainWindow(QWidget):
             brush_pixle_size = int(self.edit_brush_pixle_size.text())
             self.label_img.update_brush_pixle_size(brush_pixle_size)
 
+    def on_edit_mask_opacity_change(self):
+        if self.edit_mask_opacity.text():
+            self.label_img.update_mask_opacity(int(self.edit_mask_opacity.text()) / 100)
+            if self.thumb_cache:
+                self.thumb_cache.overlay_opacity = self.label_img.mask_opacity
+                self.thumb_model.refresh()
+
     def on_edit_eraser_pixle_size_change(self):
         if self.edit_eraser_pixle_size.text():
             eraser_pixle_size = int(self.edit_eraser_pixle_size.text())
@@ -485,9 +3623,22 @@ class MainWindow(QWidget):
             self.btn_roate_img.setEnabled(False)
             self.btn_roate_mask.setEnabled(False)
             self.btn_clear_mask.setEnabled(False)
+            self.btn_next_unannotated_img.setEnabled(False)
+            self.btn_batch_roate.setEnabled(False)
+            self.btn_undo.setEnabled(False)
+            self.btn_redo.setEnabled(False)
+            for btn in self.mask_op_buttons():
+                btn.setEnabled(False)
+            self.label_img.setEnabled(self.batch_rotate_thread is None)
+
+            if self.batch_rotate_thread is not None:
+                return
 
             if not self.all_img_file:
-                self.label_status_running1.setText('请选择需要标注的目录')
+                if self.dir_scanner is not None:
+                    self.label_status_running1.setText('正在扫描目录...')
+                else:
+                    self.label_status_running1.setText('请选择需要标注的目录')
                 self.label_status_page_number.hide()
                 self.label_status_running2.hide()
             else:
@@ -498,6 +3649,12 @@ class MainWindow(QWidget):
                 self.label_status_page_number_validator.setRange(1, len(self.all_img_file))
                 self.label_status_page_number.setText(f'{self.all_img_file_index+1}')
                 self.label_status_running1.setText( f'当前图片: {img_name} ({self.all_img_file_index + 1}/{len(self.all_img_file)}) 跳转到')
+                if self.mask_index:
+                    self.label_status_running1.setText(f'已标注: {self.mask_index.annotated_count}/{len(self.all_img_file)} {self.label_status_running1.text()}')
+                if img_name != self.current_img_path:
+                    self.label_status_running1.setText(f'{self.label_status_running1.text()} (正在加载...)')
+                if self.dir_scanner is not None:
+                    self.label_status_running1.setText(f'{self.label_status_running1.text()} (正在扫描目录...)')
                 self.label_status_running2.setText(f'张')
 
 
@@ -511,23 +3668,98 @@ class MainWindow(QWidget):
                 else:
                     self.btn_next_img.setEnabled(True)
 
-                self.btn_roate.setEnabled(True)
-                self.btn_roate_img.setEnabled(True)
-                self.btn_roate_mask.setEnabled(True)
-                self.btn_clear_mask.setEnabled(True)
+                # 翻页加载完成之前, 修改图片和mask的操作会作用到还没显示的图片上, 先禁用
+                loaded = img_name == self.current_img_path
+                self.btn_roate.setEnabled(loaded)
+                self.btn_roate_img.setEnabled(loaded)
+                self.btn_roate_mask.setEnabled(loaded)
+                self.btn_clear_mask.setEnabled(loaded)
+                self.btn_next_unannotated_img.setEnabled(self.mask_index is not None)
+                self.btn_batch_roate.setEnabled(True)
+                self.btn_undo.setEnabled(self.label_img.undo_history.can_undo(self.label_img.mask_img_path))
+                self.btn_redo.setEnabled(self.label_img.undo_history.can_redo(self.label_img.mask_img_path))
+                for btn in self.mask_op_buttons():
+                    btn.setEnabled(loaded)
         except:
             logging.exception('update_btn_status exception')
 
 
+    def request_label_img(self):
+        # 按住方向键或者连续跳转时, 只有最后请求的图片会被完整加载, 过时的加载任务直接丢弃
+        if not self.all_img_file:
+            return
+
+        if self.dir_scanner is not None:
+            self.dir_scan_navigated = True
+
+        img_path = self.all_img_file[self.all_img_file_index]
+        if img_path == self.current_img_path:
+            # 翻回了正在显示的图片, 不需要重新加载
+            self.nav_generation += 1
+            self.nav_pool.clear()
+            self.select_filmstrip_item()
+            return
+
+        mask_img_path = find_mask_img_path(img_path, self.mask_format)
+        img_key = image_cache_key('img', img_path, self.label_img_size)
+        mask_key = image_cache_key('mask', mask_img_path)
+        if (img_key is None or self.img_cache.contains(img_key)) and \
+                (mask_key is None or self.img_cache.contains(mask_key) or self.mask_saver.pending_image(get_mask_img_path(img_path, self.mask_format)) is not None):
+            # 已经预读过, 直接显示
+            self.show_label_img()
+            return
+
+        self.nav_generation += 1
+        self.nav_pool.clear()
+        self.prefetch_pool.clear()
+        self.select_filmstrip_item()
+        self.nav_pool.start(NavLoadTask(self.img_cache, img_path, mask_img_path, self.label_img_size,
+                                        self.nav_generation, self.nav_loaded.emit))
+
+    def on_nav_loaded(self, generation):
+        if generation != self.nav_generation:
+            return
+        try:
+            self.show_label_img()
+        finally:
+            self.update_btn_status()
+
+    @profiled('navigate')
     def show_label_img(self, do_roate=False, do_roate_img=False, do_roate_mask=False, do_clear=False):
         if not self.all_img_file:
             return
 
+        # 直接显示时作废还在进行的翻页加载
+        self.nav_generation += 1
+
         img_path = self.all_img_file[self.all_img_file_index]
-        img = QPixmap(str(img_path))
+        if img_path != self.current_img_path:
+            self.label_img.save_mask_img()
+            self.mask_saver.flush()
+            self.current_img_path = img_path
+
+        if do_roate or do_roate_img:
+            self.thumb_model.invalidate_stem(img_path.stem)
+            try:
+                rotate_img_file(img_path)
+            except Exception as e:
+                logging.exception(f'rotate {img_path} exception')
+                QMessageBox.warning(self, '<错误>', f'图片<{img_path}>旋转失败: {e}', QMessageBox.Ok)
 
-        img_mask_path = img_path.parent.joinpath(f'mask/{img_path.stem}.bmp')
+        img = self.img_cache.load('img', img_path, self.label_img_size)
+        img = QPixmap.fromImage(img) if img is not None else QPixmap()
+
+        pyramid = self.label_img.pyramid
+        if pyramid is None or pyramid.path != img_path or do_roate or do_roate_img:
+            self.tile_pool.clear()
+            pyramid = ImagePyramid(img_path, self.img_cache, self.tile_pool)
+        mask_img_size = self.mask_img_size
+        if mask_img_size is None:
+            mask_img_size = pyramid.size if not pyramid.size.isEmpty() else self.label_img_size
+
+        img_mask_path = get_mask_img_path(img_path, self.mask_format)
         img_mask_path.parent.mkdir(parents=True, exist_ok=True)
+        saved_mask_path = find_mask_img_path(img_path, self.mask_format)
 
         if img_mask_path.is_dir():
             QMessageBox.warning(
@@ -538,40 +3770,353 @@ class MainWindow(QWidget):
             )
             sys.exit(-1)
 
-        if img_mask_path.exists():
-            img_mask = QPixmap(str(img_mask_path))
-            if img_mask.size() != self.mask_img_size:
-                os.remove(str(img_mask_path))
+        img_mask = None
+        pending_mask = self.mask_saver.pending_image(img_mask_path)
+        if pending_mask is not None:
+            img_mask = to_mask_image(pending_mask)
+        elif saved_mask_path.exists():
+            img_mask = self.img_cache.load('mask', saved_mask_path)
+            # 图片和mask一起旋转时, 旋转前的mask是转置后的大小
+            expected_size = mask_img_size.transposed() if do_roate else mask_img_size
+            if img_mask is not None and img_mask.size() != expected_size:
+                # 只在内存里缩放用于显示, 不覆盖原来的文件, 修改之后才会按新的大小保存
+                img_mask = to_mask_image(resample_mask_image(img_mask, expected_size))
 
-        if not img_mask_path.exists() or do_clear:
-            img_mask = QPixmap(self.mask_img_size)
-            img_mask.fill(QColor(0, 0, 0))
-            img_mask.save(str(img_mask_path))
+        if img_mask is None or do_clear:
+            img_mask = new_mask_image(mask_img_size)
+            self.save_mask_img(img_mask_path, img_mask)
 
-        if do_roate:
+        if do_roate_mask and img_mask.size() != img_mask.size().transposed():
+            QMessageBox.warning(self, '<错误>', f'mask<{img_mask_path}>不是正方形, 不能单独旋转', QMessageBox.Ok)
+        elif do_roate or do_roate_mask:
             rm = QMatrix()
             rm.rotate(90)
-            img = img.transformed(rm)
-            img.save(str(img_path))
-            img_mask = img_mask.transformed(rm)
-            img_mask.save(str(img_mask_path))
+            img_mask = to_mask_image(img_mask.transformed(rm))
+            self.save_mask_img(img_mask_path, img_mask)
 
-        if do_roate_img:
-            rm = QMatrix()
-            rm.rotate(90)
-            img = img.transformed(rm)
-            img.save(str(img_path))
+        self.label_img.update_label_img(img, img_mask, str(img_mask_path), record_undo=do_clear or do_roate or do_roate_mask, pyramid=pyramid)
+        self.select_filmstrip_item()
+        self.prefetch_neighbors()
 
-        if do_roate_mask:
-            rm = QMatrix()
-            rm.rotate(90)
-            img_mask = img_mask.transformed(rm)
-            img_mask.save(str(img_mask_path))
+def make_benchmark_dir(directory, count, size):
+    # 生成带渐变和色块的jpeg, 避免纯色图片解码过快
+    gradient = np.linspace(0, 255, size[0], dtype=np.float64)
+    for i in range(count):
+        img = QImage(size[0], size[1], QImage.Format_RGB32)
+        arr = qimage_to_array(img, writable=True)
+        arr[:, :, 0] = gradient.astype(np.uint8)
+        arr[:, :, 1] = np.linspace(0, 255, size[1], dtype=np.float64).astype(np.uint8)[:, None]
+        arr[:, :, 2] = (i * 37) % 256
+        arr[:, :, 3] = 255
+        painter = QPainter(img)
+        painter.fillRect(QRect(size[0] // 4, size[1] // 4, size[0] // 3, size[1] // 3), QColor(i * 53 % 256, 80, 160))
+        painter.end()
+        img.save(os.path.join(directory, f'bench_{i:06d}.jpg'), 'JPG', 90)
+
+
+def wait_until(app, predicate, timeout=60):
+    start = time.perf_counter()
+    while not predicate():
+        app.processEvents()
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError('benchmark wait timeout')
+        time.sleep(0.001)
+
+
+def run_benchmark(count, size, frames, mask_format='bmp', mask_img_size=QSize(512, 512), cache_mb=512, prefetch_count=3):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    directory = tempfile.mkdtemp(prefix='masklabel_bench_')
+    results = {}
+    try:
+        start = time.perf_counter()
+        make_benchmark_dir(directory, count, size)
+        generate_time = time.perf_counter() - start
+
+        widget = MainWindow(mask_format=mask_format, mask_img_size=mask_img_size, cache_mb=cache_mb, prefetch_count=prefetch_count)
+        widget.show()
+        app.processEvents()
+
+        # 扫描目录: 从开始扫描到扫描线程结束, 第一次之后目录已经在系统缓存里
+        scan_times = []
+        for _ in range(5):
+            start = time.perf_counter()
+            widget.open_dir(directory)
+            wait_until(app, lambda: widget.dir_scanner is None)
+            scan_times.append(time.perf_counter() - start)
+        results['scan_dir'] = percentile_stats(scan_times)
+
+        label = widget.label_img
+        wait_until(app, lambda: label.label_img is not None)
+
+        # 整帧重绘和合成
+        paint_times = []
+        compose_times = []
+        for _ in range(frames):
+            start = time.perf_counter()
+            label.repaint()
+            paint_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            label.update_display_img()
+            compose_times.append(time.perf_counter() - start)
+        results['paint_frame'] = percentile_stats(paint_times)
+        results['compose_frame'] = percentile_stats(compose_times)
+
+        # 模拟鼠标拖动绘制, 每个移动事件都立即绘制到mask上并重绘
+        center = label.img_rect.center()
+        stroke_times = []
+        save_times = []
+        for stroke in range(max(1, frames // 50)):
+            pos = center + QPoint(-100, -100 + stroke * 7)
+            app.sendEvent(label, QMouseEvent(QEvent.MouseButtonPress, QPointF(pos), Qt.LeftButton, Qt.LeftButton, Qt.NoModifier))
+            for i in range(50):
+                pos = center + QPoint(-100 + i * 4, -100 + stroke * 7 + (i % 5))
+                start = time.perf_counter()
+                app.sendEvent(label, QMouseEvent(QEvent.MouseMove, QPointF(pos), Qt.NoButton, Qt.LeftButton, Qt.NoModifier))
+                label.stroke_engine.flush()
+                label.repaint()
+                stroke_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            app.sendEvent(label, QMouseEvent(QEvent.MouseButtonRelease, QPointF(pos), Qt.LeftButton, Qt.NoButton, Qt.NoModifier))
+            save_times.append(time.perf_counter() - start)
+        results['stroke_move'] = percentile_stats(stroke_times)
+        results['mouse_release_save'] = percentile_stats(save_times)
+
+        # 翻页: 先逐张往后(有预读), 再跳转到随机位置(没有预读)
+        widget.all_img_file_index = 0
+        widget.show_label_img()
+        widget.update_btn_status()
+        next_times = []
+        for _ in range(min(count - 1, frames)):
+            start = time.perf_counter()
+            widget.on_btn_next_img()
+            wait_until(app, lambda: widget.current_img_path == widget.all_img_file[widget.all_img_file_index])
+            label.repaint()
+            next_times.append(time.perf_counter() - start)
+            app.processEvents()
+        results['navigate_next'] = percentile_stats(next_times)
+
+        def drop_caches():
+            # 等预读和加载任务结束后清空缓存, 保证计时的是真正从磁盘读取和解码
+            widget.prefetch_pool.clear()
+            widget.prefetch_pool.waitForDone()
+            widget.nav_pool.waitForDone()
+            app.processEvents()
+            widget.img_cache.clear()
+
+        # 按住方向键: 从随机位置连续往后翻20张, 计时到最后一张显示出来
+        hold_times = []
+        rng = np.random.RandomState(0)
+        for index in rng.randint(0, max(1, count - 20), 10):
+            widget.all_img_file_index = int(index)
+            widget.show_label_img()
+            widget.update_btn_status()
+            drop_caches()
+            start = time.perf_counter()
+            for _ in range(min(20, count - 1)):
+                widget.btn_next_img.click()
+                app.processEvents()
+            wait_until(app, lambda: widget.current_img_path == widget.all_img_file[widget.all_img_file_index])
+            label.repaint()
+            hold_times.append(time.perf_counter() - start)
+        results['navigate_hold'] = percentile_stats(hold_times)
+
+        jump_times = []
+        rng = np.random.RandomState(0)
+        for index in rng.randint(0, count, min(count, 50)):
+            drop_caches()
+            start = time.perf_counter()
+            widget.all_img_file_index = int(index)
+            widget.request_label_img()
+            wait_until(app, lambda: widget.current_img_path == widget.all_img_file[widget.all_img_file_index])
+            label.repaint()
+            jump_times.append(time.perf_counter() - start)
+        results['navigate_jump'] = percentile_stats(jump_times)
+
+        widget.close()
+        app.processEvents()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'meta': {
+            'python': sys.version.split()[0],
+            'qt': QtCore.qVersion(),
+            'platform': sys.platform,
+            'images': count,
+            'image_size': list(size),
+            'frames': frames,
+            'mask_format': mask_format,
+            'generate_s': generate_time,
+        },
+        'results': results,
+    }
+
+
+def compare_benchmark(result, baseline, threshold=0.2, metric='p50_ms'):
+    # 比基线慢超过threshold比例的项目认为是性能回退
+    regressions = []
+    for name, stats in sorted(result['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if not base or metric not in base or metric not in stats:
+            print(f'{name:20s} {stats.get(metric, 0):10.3f}ms    (没有基线)')
+            continue
+
+        ratio = stats[metric] / max(base[metric], 1e-6)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  <== 变慢'
+            regressions.append(name)
+        print(f'{name:20s} {stats[metric]:10.3f}ms  基线 {base[metric]:10.3f}ms  {ratio:6.2f}x{flag}')
+    return regressions
+
+
+def parse_mask_size(text):
+    if text == 'native':
+        return None
+    try:
+        w, h = [int(x) for x in text.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'无效的mask大小: {text}')
+    return QSize(w, h)
+
+
+# Qt自己处理的命令行参数, 解析前去掉, 值为True的需要带一个参数
+QT_ARGS = {
+    '-style': True, '-stylesheet': True, '-platform': True, '-platformpluginpath': True, '-platformtheme': True,
+    '-plugin': True, '-qwindowgeometry': True, '-qwindowtitle': True, '-qwindowicon': True, '-session': True,
+    '-display': True, '-geometry': True, '-reverse': False, '-widgetcount': False, '-nograb': False, '-dograb': False,
+}
+
+
+def strip_qt_args(argv):
+    result = []
+    i = 0
+    while i < len(argv):
+        name = argv[i].split('=', 1)[0]
+        if name in QT_ARGS:
+            i += 2 if QT_ARGS[name] and '=' not in argv[i] else 1
+            continue
+        result.append(argv[i])
+        i += 1
+    return result
+
+
+def add_common_args(parser, defaults=True):
+    # 子命令里也可以写这些参数, 子命令的默认值用SUPPRESS, 不会覆盖写在子命令前面的值
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+
+    parser.add_argument('--mask-format', choices=MASK_FORMATS, default=default('bmp'), help='mask的保存格式')
+    parser.add_argument('--profile', nargs='?', const='', default=default(None), metavar='TRACE_JSON',
+                        help='启用性能统计, 指定文件时退出后导出chrome://tracing格式的json, 也可以用环境变量MASKLABEL_PROFILE启用')
+    parser.add_argument('--mask-size', type=parse_mask_size, default=default(QSize(512, 512)), help='mask的大小, 例如512x512, native表示和原图一样大')
+    parser.add_argument('--cache-mb', type=int, default=default(512), help='解码图片缓存的内存上限(MB)')
+    parser.add_argument('--prefetch', type=int, default=default(3), help='预读当前图片前后各多少张')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='MASK标注工具')
+    add_common_args(parser)
+    common_parser = argparse.ArgumentParser(add_help=False)
+    add_common_args(common_parser, defaults=False)
+    subparsers = parser.add_subparsers(dest='command')
+
+    convert_parser = subparsers.add_parser('convert-masks', parents=[common_parser], help='把目录下的mask批量无损转换成指定格式')
+    convert_parser.add_argument('directory', help='图片目录, mask在它下面的mask目录里')
+    convert_parser.add_argument('--workers', type=int, default=None, help='并行的进程数, 默认为CPU核数')
+    convert_parser.add_argument('--remove-source', action='store_true', help='转换并校验成功后删除原来的mask')
+
+    resample_parser = subparsers.add_parser('resample-masks', parents=[common_parser], help='把大小和--mask-size不一致的mask按最近邻缩放到目标大小')
+    resample_parser.add_argument('directory', help='图片目录, mask在它下面的mask目录里')
+    resample_parser.add_argument('--workers', type=int, default=None, help='并行的进程数, 默认为CPU核数')
+
+    bench_parser = subparsers.add_parser('benchmark', parents=[common_parser], help='在无界面模式下测试标注常用操作的耗时')
+    bench_parser.add_argument('--images', type=int, default=200, help='生成的测试图片数量')
+    bench_parser.add_argument('--image-size', type=int, nargs=2, default=[1920, 1080], metavar=('WIDTH', 'HEIGHT'), help='测试图片的大小')
+    bench_parser.add_argument('--frames', type=int, default=200, help='每项测试的重复次数')
+    bench_parser.add_argument('--output', default=None, help='把结果写入json文件')
+    bench_parser.add_argument('--baseline', default=None, help='和之前保存的json结果比较')
+    bench_parser.add_argument('--threshold', type=float, default=0.2, help='比基线慢多少比例算作性能回退')
+
+    export_parser = subparsers.add_parser('export', parents=[common_parser], help='把图片和mask导出成可以内存映射的numpy数据集')
+    export_parser.add_argument('directory', help='图片目录, mask在它下面的mask目录里')
+    export_parser.add_argument('out_dir', help='导出目录, 生成images.npy, masks.npy和index.csv')
+    export_parser.add_argument('--size', type=int, nargs=2, default=[512, 512], metavar=('WIDTH', 'HEIGHT'), help='导出的图片大小')
+    export_parser.add_argument('--workers', type=int, default=None, help='并行的进程数, 默认为CPU核数')
+    export_parser.add_argument('--chunk-size', type=int, default=256, help='每个进程一次处理的图片数量')
+    export_parser.add_argument('--masks-only', action='store_true', help='只导出mask')
+
+    report_parser = subparsers.add_parser('report', parents=[common_parser], help='统计每个mask的标注面积, 外接框和连通域个数, 检查空mask, 几乎全满的mask和配对错误')
+    report_parser.add_argument('directory', help='图片目录, mask在它下面的mask目录里')
+    report_parser.add_argument('--csv', default=None, help='把每张图片的结果写入csv文件')
+    report_parser.add_argument('--json', default=None, help='把每张图片的结果和汇总写入json文件')
+    report_parser.add_argument('--full-ratio', type=float, default=0.99, help='标注面积超过这个比例算作几乎全满')
+    report_parser.add_argument('--workers', type=int, default=None, help='并行的进程数, 默认为CPU核数')
+    report_parser.add_argument('--chunk-size', type=int, default=256, help='每个进程一次处理的图片数量')
+
+    import_parser = subparsers.add_parser('import-masks', parents=[common_parser], help='把模型输出的概率图或类别图批量导入为初始mask, 跳过导入后手工修改过的mask')
+    import_parser.add_argument('pred_dir', help='预标注目录, 支持png, bmp和npy, 按文件名和图片配对')
+    import_parser.add_argument('directory', help='图片目录, mask保存在它下面的mask目录里')
+    import_parser.add_argument('--threshold', type=float, default=None, help='概率阈值(0~1), 默认为0.5, 灰度图片按阈值*255比较; 调色板图片, 整数数组和只有0/1的灰度图片是类别图, 不指定时按非0取前景')
+    import_parser.add_argument('--label', type=int, default=None, help='只导入这个类别编号')
+    import_parser.add_argument('--workers', type=int, default=None, help='并行的进程数, 默认为CPU核数')
+    import_parser.add_argument('--force', action='store_true', help='覆盖已有的mask, 包括手工修改过的')
+
+    return parser.parse_args(strip_qt_args(argv))
 
-        self.label_img.update_label_img(img, img_mask, str(img_mask_path))
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    args = parse_args(sys.argv[1:])
+
+    profile = args.profile if args.profile is not None else os.environ.get('MASKLABEL_PROFILE')
+    if profile is not None and profile != '0':
+        profiler.enable(profile if profile not in ['', '1'] else None)
+
+    if args.command == 'convert-masks':
+        results = convert_masks(args.directory, args.mask_format, args.workers, args.remove_source)
+        sys.exit(1 if results['failed'] else 0)
+
+    if args.command == 'resample-masks':
+        size = (args.mask_size.width(), args.mask_size.height()) if args.mask_size is not None else None
+        results = resample_masks(args.directory, args.mask_format, size, args.workers)
+        sys.exit(1 if results['failed'] else 0)
+
+    if args.command == 'benchmark':
+        result = run_benchmark(args.images, tuple(args.image_size), args.frames, args.mask_format, args.mask_size, args.cache_mb, args.prefetch)
+        text = json.dumps(result, indent=2, ensure_ascii=False)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            print(text)
+
+        if args.baseline:
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+            regressions = compare_benchmark(result, baseline, args.threshold)
+            sys.exit(1 if regressions else 0)
+        sys.exit(0)
+
+    if args.command == 'export':
+        export_dataset(args.directory, args.out_dir, args.mask_format, tuple(args.size), args.workers, args.chunk_size, not args.masks_only)
+        sys.exit(0)
+
+    if args.command == 'import-masks':
+        size = (args.mask_size.width(), args.mask_size.height()) if args.mask_size is not None else None
+        results = import_masks(args.pred_dir, args.directory, args.mask_format, size, args.threshold, args.label, args.workers, args.force)
+        sys.exit(1 if results['failed'] else 0)
+
+    if args.command == 'report':
+        size = (args.mask_size.width(), args.mask_size.height()) if args.mask_size is not None else None
+        report_dataset(args.directory, args.mask_format, size, args.csv, args.json, args.full_ratio, args.workers, args.chunk_size)
+        sys.exit(0)
+
     app = QApplication(sys.argv)
-    widget = MainWindow()
+    widget = MainWindow(mask_format=args.mask_format, mask_img_size=args.mask_size, cache_mb=args.cache_mb, prefetch_count=args.prefetch)
     widget.show()
     sys.exit(app.exec_())